@@ -4,6 +4,7 @@ import os
 import webapp2
 
 from config.constants import SESSION_KEY
+from router import Router
 
 # URL routes
 from controllers import admin, api, dev, error, home, index, job, sitemap, static, user
@@ -22,12 +23,31 @@ ROUTES = [
     ('/user/resetpassword', user.ResetPasswordController),
     ('/terms', static.StaticController),
     ('/privacy', static.StaticController),
-    ('/sitemap.xml', sitemap.SitemapController),
+    (r'/sitemap\.xml', sitemap.SitemapController),
+    (r'/sitemaps/(\d+)\.xml', sitemap.SitemapShardController),
     ('/admin', admin.AdminController),
+    ('/admin/export', admin.ExportController),
+    (r'/admin/exports/(\d+)', admin.ExportFileController),
+    ('/admin/users', admin.UsersController),
+    ('/api/auths', api.AuthsController),
+    ('/api/pic', api.PicController),
+    ('/api/token', api.TokenController),
     ('/api/upload', api.UploadController),
+    ('/api/uploads', api.UploadSessionsController),
+    (r'/api/uploads/(\d+)', api.UploadSessionController),
+    ('/api/user', api.UserController),
     ('/dev', dev.DevController),
+    ('/job/activity', job.ActivityController),
     ('/job/auths', job.AuthsController),
     ('/job/email', job.EmailController),
+    ('/job/export', job.ExportController),
+    ('/job/image', job.ImageController),
+    ('/job/image/delete', job.ImageDeleteController),
+    ('/job/migrate/auths', job.MigrateAuthsController),
+    ('/job/migrate/users', job.MigrateUsersController),
+    ('/job/revoke', job.RevokeController),
+    ('/job/sitemap', job.SitemapController),
+    ('/job/stats', job.StatsController),
     # ('/errors/(.*)', static.StaticController), # uncomment to test static error pages
     ('/logerror', error.LogErrorController),
     ('/policyviolation', error.PolicyViolationController),
@@ -52,4 +72,6 @@ config = {'webapp2_extras.sessions': {
 }}
 
 # make sure debug is False for production
-app = webapp2.WSGIApplication(ROUTES, config=config, debug=False)
+app = webapp2.WSGIApplication(config=config, debug=False)
+# routes are looked up by path instead of tried one by one, see `router.Router`
+app.router = Router(ROUTES)
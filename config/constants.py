@@ -15,3 +15,8 @@ SESSION_KEY = os.environ.get('SESSION_KEY', 'replace with the output from os.ura
 SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY', '')
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'replace.sender@yourdomain.com')
 SUPPORT_EMAIL = os.environ.get('SUPPORT_EMAIL', 'replace.support@yourdomain.com')
+
+# Sitemap
+# the canonical URL crawlers are sent to, like https://www.yourdomain.com
+# without it the host of the first request for the sitemap is used
+BASE_URL = os.environ.get('BASE_URL', '')
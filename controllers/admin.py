@@ -1,14 +1,167 @@
-from base import BaseController, withUser
+import urllib
+from datetime import datetime, timedelta
 
+from base import FormController, withUser
+import model
+from user import EMAIL_FIELD
 
-class AdminController(BaseController):
-    """ handles request for the admin page """
+import cloudstorage as gcs
+
+
+class BaseAdminController(FormController):
 
     @withUser
-    def before(self):
+    def before(self, *args):
         if not self.user.is_admin:
             return self.renderError(403)
 
+
+class AdminController(BaseAdminController):
+    """ handles request for the admin page """
+
+    FIELDS = {"email": EMAIL_FIELD}
+
+    SIGNUP_DAYS = 14
+    BREAKDOWNS = ['browser', 'os', 'device']
+
+    def get(self):
+
+        stats = model.getStats()
+
+        today = datetime.utcnow().date()
+        days = [(today - timedelta(i)).isoformat() for i in xrange(self.SIGNUP_DAYS)]
+        signups = [(day, stats.get('signups:' + day, 0)) for day in days]
+
+        # each breakdown is a list of (name, sessions) tuples with the most common first
+        breakdowns = dict((prefix, []) for prefix in self.BREAKDOWNS)
+        for name, count in stats.items():
+            prefix, _, value = name.partition(':')
+            if prefix in breakdowns:
+                breakdowns[prefix].append((value, count))
+        for breakdown in breakdowns.values():
+            breakdown.sort(key=lambda item: item[1], reverse=True)
+
+        self.renderTemplate('admin/index.html', missing_paths=model.getMissingPaths(), stats=stats,
+            signups=signups, breakdowns=breakdowns)
+
+    def post(self):
+
+        if self.request.get("revoke"):
+            form_data, errors, valid_data = self.validate()
+            if not errors:
+                user = model.User.getByEmail(valid_data["email"])
+                if user:
+                    self.revokeAuths(user.key)
+                    self.flash("success", "Access revoked for all of that user's sessions.")
+                else:
+                    errors["exists"] = True
+            if errors:
+                return self.redisplay(form_data, errors)
+
+        self.redisplay()
+
+
+class UsersController(BaseAdminController):
+    """ finds users by the start of any word in their name or email, and by when they signed up """
+
+    PAGE_SIZE = 20
+    DATE_FORMAT = '%Y-%m-%d'
+
     def get(self):
 
-        self.renderTemplate('admin/index.html')
+        params = {}
+        for name in ['q', 'start', 'end']:
+            value = self.request.get(name).strip()
+            if value:
+                params[name] = value
+
+        invalid = {}
+        dates = {}
+        for name in ['start', 'end']:
+            if name in params:
+                try:
+                    dates[name] = datetime.strptime(params[name], self.DATE_FORMAT)
+                except ValueError:
+                    invalid[name] = True
+        if 'end' in dates:
+            # the end date is included
+            dates['end'] += timedelta(1)
+
+        cursor = None
+        str_cursor = self.request.get('cursor')
+        if str_cursor:
+            try:
+                cursor = model.ndb.Cursor(urlsafe=str_cursor)
+            except Exception:
+                # an invalid cursor just starts back at the first page
+                pass
+
+        users = []
+        search_url = next_url = None
+        searched = params and not invalid
+        if searched:
+            query = model.User.search(params.get('q'), dates.get('start'), dates.get('end'))
+            users, next_cursor, more = query.fetch_page(self.PAGE_SIZE, start_cursor=cursor)
+
+            search_url = '/admin/users?' + urllib.urlencode([(name, param.encode('utf-8'))
+                for name, param in sorted(params.items())])
+            if more and next_cursor:
+                next_url = search_url + '&cursor=' + next_cursor.urlsafe()
+
+        self.renderTemplate('admin/users.html', users=users, params=params, invalid=invalid, searched=searched,
+            search_url=search_url, next_url=next_url, is_first_page=cursor is None)
+
+
+class ExportController(BaseAdminController):
+    """ starts exporting every entity of a kind, the admin is emailed a link once it's done """
+
+    def post(self):
+
+        kind = self.request.get('kind')
+        export_format = self.request.get('format')
+        if kind not in model.Export.KINDS or export_format not in model.Export.FORMATS:
+            self.flash('error', 'Please choose what to export.')
+            return self.redirect('/admin')
+
+        # the ID is needed for the file name before the export can be saved
+        export_id = model.Export.allocate_ids(1)[0]
+        path = '/' + self.gcs_bucket + '/exports/' + str(export_id) + '.' + export_format
+        export = model.Export(id=export_id, kind=kind, format=export_format, gcs_path=path, email=self.user.email,
+            host_url=self.request.host_url)
+        model.saveExport(export)
+
+        self.flash('success', 'Export started. You will be emailed a link when it is done.')
+        self.redirect('/admin')
+
+
+class ExportFileController(BaseAdminController):
+
+    READ_BYTES = 256 * 1024
+
+    def get(self, export_id):
+
+        export = model.Export.get_by_id(int(export_id))
+        if not export or export.status != model.Export.FINISHED:
+            return self.renderError(404)
+
+        # the file is opened first so that a missing one gets an error page instead of an empty download
+        try:
+            f = gcs.open(export.gcs_path, read_buffer_size=self.READ_BYTES)
+        except gcs.NotFoundError:
+            return self.renderError(404)
+
+        self.response.headers['Content-Type'] = model.Export.FORMATS[export.format]
+        self.response.headers['Content-Disposition'] = 'attachment; filename=' + export.filename
+        if self.request.method == 'HEAD':
+            f.close()
+        else:
+            self.renderStream(self.readFile(f))
+
+    def readFile(self, f):
+        # the file is sent on a chunk at a time instead of being read into memory
+        with f:
+            while True:
+                chunk = f.read(self.READ_BYTES)
+                if not chunk:
+                    break
+                yield chunk
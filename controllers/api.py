@@ -1,13 +1,222 @@
+import logging
+import mimetypes
+import zlib
+from datetime import datetime
+
 from google.appengine.ext import blobstore
 
-from base import BaseController, withUser
+try:
+    # much faster when its C speedups are available
+    from simplejson import JSONEncoder
+except ImportError:
+    from json import JSONEncoder
+
+from base import BaseController, FormController
+import helpers
+import model
+from ratelimit import Limit
+import resumable
+from user import EMAIL_FIELD, IMAGE_TYPES, PASSWORD_FIELD
+
+import cloudstorage as gcs
 
 SIZE_LIMIT = 10 * (2 ** 20) # 10 MB
+# resumable uploads never pass through an instance, so they can be much larger
+RESUMABLE_SIZE_LIMIT = 100 * (2 ** 20) # 100 MB
+
+
+def serializeEntity(entity):
+    """ only the properties a model lists in `API_FIELDS` are ever included """
+    data = {'key': entity.key.urlsafe()}
+    for name in entity.API_FIELDS:
+        data[name] = getattr(entity, name)
+    return data
+
+
+def encodeDefault(value):
+    # called by the encoder for anything it doesn't already know how to handle
+    if isinstance(value, model.ndb.Model) and hasattr(value, 'API_FIELDS'):
+        return serializeEntity(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, model.ndb.Key):
+        return value.urlsafe()
+    if isinstance(value, blobstore.BlobKey):
+        return str(value)
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def gzipChunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def withAPIUser(action):
+    def decorate(*args, **kwargs):
+        controller = args[0]
+        if controller.user:
+            return action(*args, **kwargs)
+        else:
+            return controller.renderJSONError(401, 'unauthorized')
+    return decorate
+
+
+class APIController(BaseController):
+    """ renders JSON for API clients, anything with `API_FIELDS` can be included in a response as is
+        clients can sign in with a token from `TokenController` instead of a session cookie """
+
+    ALLOW_TOKEN = True
+
+    # anything with the same `encode` and `iterencode` methods can be swapped in here
+    ENCODER = JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=encodeDefault)
+
+    PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+
+    # smaller responses aren't worth compressing
+    COMPRESS_BYTES = 1024
+
+    def acceptsGzip(self):
+        return 'gzip' in self.request.headers.get('Accept-Encoding', '')
+
+    def encode(self, data):
+        encoded = self.ENCODER.encode(data)
+        if isinstance(encoded, unicode):
+            encoded = encoded.encode('utf-8')
+        return encoded
+
+    def renderAPI(self, data):
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if self.request.method != 'HEAD':
+            body = self.encode(data)
+            if len(body) > self.COMPRESS_BYTES and self.acceptsGzip():
+                self.response.headers['Content-Encoding'] = 'gzip'
+                body = ''.join(gzipChunks([body]))
+            self.render(body)
+
+    def renderJSONError(self, status_int, error):
+        self.response.set_status(status_int)
+        self.renderAPI({'error': error})
+
+    def renderError(self, status_int, stacktrace=None):
+        # API clients can't do anything with an HTML error page
+        self.renderJSONError(status_int, self.response.http_status_message(status_int))
+
+    def renderList(self, items, footer=None):
+        """ streams a list out one item at a time, so the whole response is never in memory at once
+            `footer` is a dict of any other values to include
+            the items should already be fetched, since anything that goes wrong after the response starts
+            can only end the list early instead of giving an error response """
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if self.request.method != 'HEAD':
+            chunks = self.listChunks(items, footer)
+            if self.acceptsGzip():
+                self.response.headers['Content-Encoding'] = 'gzip'
+                chunks = gzipChunks(chunks)
+            self.renderStream(chunks)
+
+    def listChunks(self, items, footer):
+        yield '{"items":['
+        separator = ''
+        try:
+            for item in items:
+                yield separator + self.encode(item)
+                separator = ','
+        except Exception as e:
+            # the JSON is still finished properly, with an error instead of the usual values
+            logging.exception(e)
+            self.alertError(e)
+            footer = {'error': 'incomplete'}
+        yield ']'
+        if footer:
+            for name, value in footer.items():
+                yield ',' + self.encode(name) + ':' + self.encode(value)
+        yield '}'
+
+    def renderQuery(self, query):
+        """ renders a page of query results, along with a cursor for the next page if there is one
+            the page is fetched here so that any datastore errors are handled normally """
+        try:
+            limit = min(max(int(self.request.get('limit') or self.PAGE_SIZE), 1), self.MAX_PAGE_SIZE)
+            cursor = None
+            if self.request.get('cursor'):
+                cursor = model.ndb.Cursor(urlsafe=self.request.get('cursor'))
+        except Exception:
+            # this is really a ValueError or BadValueError, but either way the client sent something wrong
+            return self.renderJSONError(400, 'invalid')
+
+        results, next_cursor, more = query.fetch_page(limit, start_cursor=cursor)
+        next_cursor = more and next_cursor and next_cursor.urlsafe() or None
+
+        self.renderList(results, {'cursor': next_cursor})
+
+
+class TokenController(APIController, FormController):
+    """ signs in with an email and password and returns a token to send as `Authorization: Bearer <token>`
+        each client (user agent) has one token at a time, so asking for another replaces it
+        revoking the auth from the sessions page revokes its token too """
+
+    # there's no session to have a CSRF in yet
+    SKIP_CSRF = True
+
+    # the same as logging in, see `user.LoginController`
+    RATE_LIMITS = [Limit('ip', 20, 60), Limit('email', 10, 60)]
+
+    FIELDS = {"email": EMAIL_FIELD, "password": PASSWORD_FIELD}
+
+    def post(self):
+
+        form_data, errors, valid_data = self.validate()
+        if errors:
+            return self.renderJSONError(400, 'invalid')
+
+        ua = self.request.headers.get('User-Agent', '')
+        ip = self.request.remote_addr or ''
+        if not ua or not ip:
+            return self.renderJSONError(400, 'client')
+
+        user, auth = model.User.getWithAuthAsync(valid_data["email"], ua).get_result()
+        if not user or model.User.hashPassword(valid_data["password"], user.password_salt) != user.hashed_password:
+            # the same error either way, like logging in
+            return self.renderJSONError(401, 'match')
+
+        new = not auth
+        if new:
+            os, browser, device = helpers.parse_user_agent(ua)
+            auth = model.Auth(key=model.Auth.keyFor(user.key, ua), user_agent=ua, os=os, browser=browser,
+                device=device, ip=ip)
 
+        token = model.issueToken(auth)
+        if new:
+            model.updateStats(model.authStats(auth))
 
-class UploadController(BaseController):
+        self.renderAPI({'token': token})
 
-    @withUser
+
+class PicController(APIController):
+
+    @withAPIUser
+    def get(self):
+
+        # polled while a new picture is being processed
+        self.renderAPI({
+            'status': self.user.pic_status,
+            'url': self.user.pic_url,
+            'thumbs': self.user.pic_thumbnails
+        })
+
+
+class UploadController(APIController):
+
+    RATE_LIMITS = [Limit('user', 30, 3600)]
+
+    @withAPIUser
     def post(self):
 
         # takes a url to redirect to after upload, returns a valid blobstore upload url
@@ -16,4 +225,101 @@ class UploadController(BaseController):
         path = self.gcs_bucket + '/' + self.user.slug
         url = blobstore.create_upload_url(redirect_url, max_bytes_per_blob=SIZE_LIMIT, gs_bucket_name=path)
 
-        self.renderJSON({'url': url})
+        self.renderAPI({'url': url})
+
+
+class UserController(APIController):
+
+    @withAPIUser
+    def get(self):
+
+        self.renderAPI({'user': self.user})
+
+
+class AuthsController(APIController):
+
+    @withAPIUser
+    def get(self):
+
+        self.renderQuery(self.user.auths)
+
+
+class UploadSessionsController(APIController):
+    """ the client sends a file straight to GCS at the returned URL, in as many chunks as it likes
+        after a dropped connection it can ask how much arrived and resume from there, see `UploadSessionController`
+        note that browsers also need a CORS policy on the bucket that allows PUT requests from this site """
+
+    RATE_LIMITS = [Limit('user', 30, 3600)]
+
+    @withAPIUser
+    def post(self):
+
+        filename = self.request.get('filename')
+        ext = '.' in filename and filename.rsplit('.', 1)[1].lower()
+        if ext not in IMAGE_TYPES:
+            return self.renderJSONError(400, 'type')
+
+        try:
+            size = int(self.request.get('size'))
+        except ValueError:
+            size = 0
+        if size <= 0 or size > RESUMABLE_SIZE_LIMIT:
+            return self.renderJSONError(400, 'size')
+
+        # the ID is needed for the file name before the upload can be saved
+        upload_id = model.Upload.allocate_ids(1, parent=self.user.key)[0]
+        path = '/' + self.gcs_bucket + '/' + self.user.slug + '/' + str(upload_id) + '.' + ext
+        session_url = resumable.startUpload(path, mimetypes.guess_type(filename)[0], size)
+
+        upload = model.Upload(id=upload_id, parent=self.user.key, gcs_path=path, session_url=session_url, size=size)
+        upload.put()
+
+        self.renderAPI({'id': upload_id, 'url': session_url, 'size': size})
+
+
+class UploadSessionController(APIController):
+
+    def getUpload(self, upload_id):
+        # uploads are in the user's entity group, so nobody else's can be found
+        return model.Upload.get_by_id(int(upload_id), parent=self.user.key)
+
+    @withAPIUser
+    def get(self, upload_id):
+
+        upload = self.getUpload(upload_id)
+        if not upload:
+            return self.renderJSONError(404, 'missing')
+
+        received = upload.size
+        if upload.status == model.Upload.STARTED:
+            complete, received = resumable.uploadProgress(upload.gcs_path, upload.session_url)
+            if complete:
+                received = upload.size
+
+        self.renderAPI({'id': upload.key.id(), 'status': upload.status, 'url': upload.session_url,
+            'size': upload.size, 'received': received})
+
+    @withAPIUser
+    def post(self, upload_id):
+
+        # called once the client has sent the whole file
+        upload = self.getUpload(upload_id)
+        if not upload:
+            return self.renderJSONError(404, 'missing')
+
+        if upload.status == model.Upload.STARTED:
+            try:
+                gcs.stat(upload.gcs_path)
+            except gcs.NotFoundError:
+                # the object only exists once the last chunk has arrived
+                return self.renderJSONError(409, 'incomplete')
+
+            upload.status = model.Upload.FINISHED
+            upload.put()
+
+            # from here on it's the same as a regular upload, see `user.IndexController`
+            gs_object_name = '/gs' + upload.gcs_path
+            blob_key = blobstore.BlobKey(blobstore.create_gs_key(gs_object_name))
+            self.changePic(self.user, gs_object_name, blob_key)
+
+        self.renderAPI({'id': upload.key.id(), 'status': upload.status, 'pic_status': self.user.pic_status})
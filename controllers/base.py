@@ -7,7 +7,7 @@ import logging
 import os
 
 # app engine api imports
-from google.appengine.api import app_identity, memcache, taskqueue, users
+from google.appengine.api import app_identity, taskqueue, users
 
 # app engine included libraries imports
 import jinja2
@@ -17,11 +17,19 @@ from webapp2_extras import sessions
 # local imports
 import helpers
 import model
+import ratelimit
 from config.constants import VIEWS_PATH, SUPPORT_EMAIL
 
 # lib imports
 from gae_html import cacheAndRender # NOQA: F401
 
+# security headers only depend on the controller, so they're compiled once for each, see `securityHeaders`
+SECURITY_HEADERS = {}
+NONCE_PLACEHOLDER = '{nonce}'
+
+# form fields are compiled into a list of steps once per controller class, see `FormController.formPlan`
+FORM_PLANS = {}
+
 
 class BaseController(webapp2.RequestHandler):
 
@@ -32,6 +40,42 @@ class BaseController(webapp2.RequestHandler):
 
     SKIP_CSRF = False
 
+    # allows `Authorization: Bearer <token>` in place of the session cookie, see `model.issueToken`
+    # requests with a token don't use the session at all, so they skip CSRF too
+    ALLOW_TOKEN = False
+    api_token = None
+
+    # how often each client can make requests to this controller, as a list of `ratelimit.Limit`s
+    RATE_LIMITS = []
+
+    # send templates out a chunk at a time instead of rendering the whole thing first, see `renderTemplate`
+    # an error partway through can only be reported, not shown, see `guardStream`
+    STREAM = False
+
+    # this is purposefully strict by default
+    # you can change site-wide or override it on a controller subclass as needed
+    # the headers are compiled once per class, so changing these on an instance has no effect
+    # see https://developers.google.com/web/fundamentals/security/csp/
+    CSP = [
+        ('default-src', "'self'"),
+        ('form-action', "'self'"),
+        ('base-uri', "'none'"),
+        ('frame-ancestors', "'none'"),
+        ('object-src', "'none'")
+    ]
+    # allows inline scripts that have `nonce="{{csp_nonce}}"`, which is different for every request
+    # so it shouldn't be used with pages that are cached
+    CSP_NONCE = False
+
+    # set to enable HSTS - note that it can have permanent consequences for your domain, e.g.
+    # HSTS = 'max-age=86400; includeSubDomains'
+    # this header is removed from non appspot domains - a custom domain must be whitelisted first
+    # see https://code.google.com/p/googleappengine/issues/detail?id=7427
+    HSTS = None
+
+    # any other headers to add to every response, as a list of (name, value) tuples
+    HEADERS = []
+
     def checkCSRF(self):
         csrf = self.session.get('csrf')
         if csrf and csrf == self.request.get('csrf'):
@@ -43,32 +87,76 @@ class BaseController(webapp2.RequestHandler):
             return False
 
     def dispatch(self):
-        # get a session store for this request
-        self.session_store = sessions.get_store(request=self.request)
-
-        # always check CSRF if this is a post unless explicitly disabled
-        if self.request.method == 'POST' and not self.SKIP_CSRF:
-            if not self.checkCSRF():
-                return self.renderError(412)
-
-        if hasattr(self, "before"):
-            try:
-                self.before(*self.request.route_args, **self.request.route_kwargs)
-            except Exception as e:
-                self.handle_exception(e, False)
-
-        # only run the regular action if there isn't already an error or redirect
-        if self.response.status_int == 200:
-            webapp2.RequestHandler.dispatch(self)
-
-            if hasattr(self, "after"):
+        # cache writes made during this request are sent together at the end, see `model.CacheBatch`
+        model.startBatch()
+        try:
+            if self.ALLOW_TOKEN:
+                authorization = self.request.headers.get('Authorization', '')
+                if authorization.startswith('Bearer '):
+                    self.api_token = authorization[7:].strip()
+
+            if self.api_token:
+                # the auth and its user are fetched together, which is the only lookup a token needs
+                keys = model.tokenKeys(self.api_token)
+                if keys:
+                    model.prefetch(keys, namespace=model.CACHE_USERS)
+                    model.prefetch([model.activityMarker(keys[0])])
+            else:
+                # get a session store for this request
+                self.session_store = sessions.get_store(request=self.request)
+
+                # the session's auth is needed on almost every request, so fetch it along with anything else up front
+                auth_key = self.session.get('auth_key')
+                if auth_key:
+                    model.prefetch([auth_key], namespace=model.CACHE_USERS)
+                    model.prefetch([model.activityMarker(auth_key)])
+
+            # turn away clients making too many requests before doing anything expensive for them
+            if self.RATE_LIMITS:
+                retry_after = self.checkRateLimits()
+                if retry_after:
+                    self.response.headers['Retry-After'] = str(retry_after)
+                    return self.renderError(429)
+
+            # always check CSRF if this is a post unless explicitly disabled
+            if self.request.method == 'POST' and not self.SKIP_CSRF and not self.api_token:
+                if not self.checkCSRF():
+                    return self.renderError(412)
+
+            if hasattr(self, "before"):
                 try:
-                    self.after(*self.request.route_args, **self.request.route_kwargs)
+                    self.before(*self.request.route_args, **self.request.route_kwargs)
                 except Exception as e:
                     self.handle_exception(e, False)
 
-        # save all sessions
-        self.session_store.save_sessions(self.response)
+            # only run the regular action if there isn't already an error or redirect
+            if self.response.status_int == 200:
+                webapp2.RequestHandler.dispatch(self)
+
+                if hasattr(self, "after"):
+                    try:
+                        self.after(*self.request.route_args, **self.request.route_kwargs)
+                    except Exception as e:
+                        self.handle_exception(e, False)
+
+            # save all sessions
+            if not self.api_token:
+                self.session_store.save_sessions(self.response)
+        finally:
+            model.endBatch()
+
+    def checkRateLimits(self):
+        limits = [limit for limit in self.RATE_LIMITS if self.request.method in limit.methods]
+        values = {}
+        for limit in limits:
+            if limit.key == 'ip':
+                values['ip'] = self.request.remote_addr
+            elif limit.key == 'user':
+                values['user'] = self.user and self.user.slug
+            else:
+                # params like emails are normalized to lowercase, so this matches however they're typed
+                values[limit.key] = self.request.get(limit.key).lower()
+        return ratelimit.check(self.__class__.__name__, limits, values)
 
     @webapp2.cached_property
     def session(self):
@@ -85,7 +173,15 @@ class BaseController(webapp2.RequestHandler):
 
     def compileTemplate(self, filename, **kwargs):
         template = self.jinja_env.get_template(filename)
+        return template.render(self.templateArgs(kwargs))
+
+    def streamTemplate(self, filename, **kwargs):
+        template = self.jinja_env.get_template(filename)
+        # small chunks so that the head goes out before the rest of the page is rendered
+        stream = template.stream(self.templateArgs(kwargs)).enable_buffering()
+        return (chunk.encode('utf-8') for chunk in stream)
 
+    def templateArgs(self, kwargs):
         # add some standard variables
         kwargs["user"] = user = self.user
         kwargs["is_admin"] = user and user.is_admin
@@ -103,27 +199,86 @@ class BaseController(webapp2.RequestHandler):
             self.session['csrf'] = csrf
         kwargs['csrf'] = csrf
 
-        return template.render(kwargs)
+        if self.CSP_NONCE:
+            kwargs['csp_nonce'] = self.csp_nonce
 
-    def render(self, content):
-        # uncomment to enable HSTS - note that it can have permanent consequences for your domain
-        # this header is removed from non appspot domains - a custom domain must be whitelisted first
-        # see https://code.google.com/p/googleappengine/issues/detail?id=7427
-        # self.response.headers['Strict-Transport-Security'] = 'max-age=86400; includeSubDomains'
-
-        # this is purposefully strict by default
-        # you can change site-wide or add logic for different environments or actions as needed
-        # see https://developers.google.com/web/fundamentals/security/csp/
-        CSP = "default-src 'self'; form-action 'self'; "
-        CSP += "base-uri 'none'; frame-ancestors 'none'; object-src 'none';"
-        CSP += "report-uri " + self.request.host_url + "/policyviolation"
-        self.response.headers['Content-Security-Policy'] = CSP
+        return kwargs
 
+    @webapp2.cached_property
+    def csp_nonce(self):
+        return os.urandom(16).encode('base64').replace('\n', '')
+
+    @classmethod
+    def securityHeaders(cls):
+        """ returns a list of (name, value) header tuples, and the CSP split around its nonce if it has one
+            the CSP ends with its report URI, which is finished with the host of each request """
+        compiled = SECURITY_HEADERS.get(cls)
+        if not compiled:
+            headers = list(cls.HEADERS)
+            if cls.HSTS:
+                headers.append(('Strict-Transport-Security', cls.HSTS))
+
+            split_csp = None
+            if cls.CSP:
+                directives = list(cls.CSP)
+                if cls.CSP_NONCE:
+                    nonce = "'nonce-" + NONCE_PLACEHOLDER + "'"
+                    names = [name for name, value in directives]
+                    if 'script-src' in names:
+                        index = names.index('script-src')
+                        directives[index] = ('script-src', directives[index][1] + ' ' + nonce)
+                    else:
+                        directives.append(('script-src', "'self' " + nonce))
+                directives.append(('report-uri', ''))
+
+                csp = '; '.join([name + ' ' + value for name, value in directives])
+                split_csp = csp.split(NONCE_PLACEHOLDER, 1)
+
+            compiled = SECURITY_HEADERS[cls] = (headers, split_csp)
+        return compiled
+
+    def setHeaders(self):
+        headers, split_csp = self.securityHeaders()
+        for name, value in headers:
+            self.response.headers[name] = value
+        if split_csp:
+            csp = split_csp[0]
+            if len(split_csp) > 1:
+                csp += self.csp_nonce + split_csp[1]
+            self.response.headers['Content-Security-Policy'] = csp + self.request.host_url + '/policyviolation'
+
+    def render(self, content):
+        self.setHeaders()
         self.response.out.write(content)
 
+    def renderStream(self, chunks):
+        # the first chunk is made right away, so an error setting up the stream is handled like any other
+        # the rest are only made as the response is sent out, after everything else in `dispatch`
+        # note that reading `response.body` (like caching does) renders the whole thing right away instead
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        self.setHeaders()
+        self.response.app_iter = self.guardStream(first, chunks)
+        self.response.content_length = None
+
+    def guardStream(self, first, chunks):
+        """ once the response has started its status can't change, so a later error is only logged and reported
+            the client gets a truncated response, so streaming is best left to pages that can't fail partway """
+        if first is not None:
+            yield first
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            logging.exception(e)
+            self.alertError(e)
+
     def renderTemplate(self, filename, **kwargs):
         if self.request.method != 'HEAD':
-            self.render(self.compileTemplate(filename, **kwargs))
+            if self.STREAM:
+                self.renderStream(self.streamTemplate(filename, **kwargs))
+            else:
+                self.render(self.compileTemplate(filename, **kwargs))
 
     def renderError(self, status_int, stacktrace=None):
         self.response.set_status(status_int)
@@ -174,34 +329,83 @@ class BaseController(webapp2.RequestHandler):
             status_int = 500
 
         self.renderError(status_int, stacktrace=stacktrace)
+        self.alertError(exception)
 
+    def alertError(self, exception):
         # send an email notifying about this error
         self.deferEmail([SUPPORT_EMAIL], "Error Alert", "error_alert.html", exception=exception,
             user=self.user, url=self.request.url, method=self.request.method)
 
-    def cache(self, key, function, expires=86400):
-        value = memcache.get(key)
-        if value is None:
-            value = function()
-            memcache.add(key, value, expires)
-        return value
+    def cache(self, key, function, expires=86400, namespace=None):
+        return model.cache(key, function, expires=expires, namespace=namespace)
 
-    def uncache(self, key, seconds=10):
-        memcache.delete(key, seconds=seconds)
+    def uncache(self, key, seconds=10, namespace=None):
+        model.uncache(key, seconds=seconds, namespace=namespace)
 
     @webapp2.cached_property
     def user(self):
         user = None
-        if 'auth_key' in self.session:
+        if self.api_token:
+            auth = model.getByToken(self.api_token)
+            if auth:
+                user = model.getByKey(auth.key.parent().urlsafe())
+                if user and self.request.remote_addr:
+                    model.recordActivity(auth.key.urlsafe(), self.request.remote_addr)
+        elif 'auth_key' in self.session:
             str_key = self.session['auth_key']
             auth = model.getByKey(str_key)
+            if not auth:
+                # sessions from before `migrateAuths` still point at the old key, so they move to the new one
+                new_key = model.migratedAuthKey(str_key, self.request.headers.get('User-Agent'))
+                if new_key:
+                    auth = model.getByKey(new_key)
+                    if auth:
+                        str_key = self.session['auth_key'] = new_key
             if auth:
                 user = auth.user
+                if self.request.remote_addr:
+                    model.recordActivity(str_key, self.request.remote_addr)
             else:
                 del self.session['auth_key']
 
         return user
 
+    def revokeAuths(self, user_key, except_key=None, cursor=None):
+        """ revokes a user's auths, handing the rest off to a task when there are too many for one request """
+        cursor = model.revokeAuths(user_key, except_key=except_key, cursor=cursor)
+        if cursor:
+            params = {'user_key': user_key.urlsafe(), 'cursor': cursor.urlsafe()}
+            if except_key:
+                params['except_key'] = except_key.urlsafe()
+            taskqueue.add(url='/job/revoke', params=params)
+
+    def changePic(self, user, gcs_path=None, blob_key=None):
+        """ replaces a user's picture, or removes it when none is given, leaving the slow parts to tasks """
+        old_pic = {}
+        if user.pic_gcs:
+            old_pic['gcs'] = user.pic_gcs
+        if user.pic_blob:
+            old_pic['blob'] = str(user.pic_blob)
+
+        user.pic_gcs = gcs_path
+        user.pic_blob = blob_key
+        user.pic_url = None
+        user.pic_thumbs = []
+        user.pic_status = blob_key and model.User.PIC_PROCESSING or None
+
+        # the tasks are only added if the user is saved, and can't run before it is
+        @model.ndb.transactional
+        def save():
+            user.put()
+            if old_pic:
+                taskqueue.add(url='/job/image/delete', params=old_pic, queue_name='images', transactional=True)
+            if blob_key:
+                params = {'user_key': user.slug, 'blob': str(blob_key), 'gcs': gcs_path or ''}
+                taskqueue.add(url='/job/image', params=params, queue_name='images', transactional=True)
+
+        save()
+        self.uncache(user.slug, namespace=model.CACHE_USERS)
+
     def deferEmail(self, to, subject, filename, reply_to=None, attachments=None, **kwargs):
         params = {'to': to, 'subject': subject}
 
@@ -227,27 +431,62 @@ class BaseController(webapp2.RequestHandler):
         taskqueue.add(url='/job/email', params=params, queue_name='mail')
 
 
+class Field(object):
+    """ describes a form field beyond just its validator
+        `normalize` is applied to a valid value, and a `sensitive` value is never sent back to be redisplayed
+        an invalid field's error is "required" when it was left empty, or `error` otherwise """
+
+    def __init__(self, validator, normalize=None, sensitive=False, error='invalid'):
+        self.validator = validator
+        self.normalize = normalize
+        self.sensitive = sensitive
+        self.error = error
+
+
 class FormController(BaseController):
 
-    # a mapping of field names to their validator functions
+    # a mapping of field names to their validator functions or `Field`s
     FIELDS = {}
 
-    def validate(self):
-        form_data = {} # all the original request data, for potentially re-displaying
-        errors = {} # only fields with errors
-        valid_data = {} # only valid fields
-
-        for name, validator in self.FIELDS.items():
-            try:
-                form_data[name] = self.request.get(name)
-            except UnicodeDecodeError:
-                return self.renderError(400)
+    def formPlan(self):
+        plan = FORM_PLANS.get(self.__class__)
+        if plan is None:
+            plan = []
+            for name, field in sorted(self.FIELDS.items()):
+                if isinstance(field, Field):
+                    plan.append((name, field.validator, field.normalize, field.sensitive, 'required', field.error))
+                else:
+                    # a plain validator function's errors are just True
+                    plan.append((name, field, None, False, True, True))
+            FORM_PLANS[self.__class__] = plan
+        return plan
 
-            valid, data = validator(form_data[name])
+    def validate(self):
+        form_data = {} # the original request data that isn't sensitive, for potentially re-displaying
+        errors = {} # only fields with errors, mapped to what was wrong with them
+        valid_data = {} # only valid fields, after they've been normalized
+
+        plan = self.formPlan()
+        try:
+            # the request is only parsed once, and the first value for a name is used the same as `request.get`
+            params = {}
+            for name, value in self.request.params.iteritems():
+                params.setdefault(name, value)
+        except UnicodeDecodeError:
+            return self.renderError(400)
+
+        for name, validator, normalize, sensitive, required_error, invalid_error in plan:
+            value = params.get(name, u'')
+            if not sensitive:
+                form_data[name] = value
+
+            valid, data = validator(value)
             if valid:
+                if normalize:
+                    data = normalize(data)
                 valid_data[name] = data
             else:
-                errors[name] = True
+                errors[name] = value and invalid_error or required_error
 
         return form_data, errors, valid_data
 
@@ -1,6 +1,6 @@
 import logging
 
-from google.appengine.api import users, memcache
+from google.appengine.api import users, memcache, taskqueue
 from google.appengine.api.namespace_manager import namespace_manager
 
 from base import FormController
@@ -20,7 +20,8 @@ class DevController(FormController):
 
     def get(self):
 
-        self.renderTemplate('dev.html', namespace=NAMESPACE, logout_url=LOGOUT_URL)
+        self.renderTemplate('dev.html', namespace=NAMESPACE, logout_url=LOGOUT_URL,
+            cache_namespaces=model.CACHE_NAMESPACES)
 
     def post(self):
 
@@ -33,7 +34,7 @@ class DevController(FormController):
                     user.put()
 
                     # the user may currently be signed in so invalidate its cache to get the new permissions
-                    self.uncache(user.key.urlsafe())
+                    self.uncache(user.key.urlsafe(), namespace=model.CACHE_USERS)
                     self.flash("success", "User successfully made admin.")
                 else:
                     errors["exists"] = True
@@ -45,6 +46,12 @@ class DevController(FormController):
             memcache.flush_all()
             self.flash('info', 'Cleared Memcache')
 
+        elif self.request.get("invalidate") in model.CACHE_NAMESPACES:
+            # only invalidates one kind of cached value, so that everything else stays warm
+            namespace = self.request.get("invalidate")
+            model.invalidateCache(namespace)
+            self.flash('info', 'Invalidated ' + namespace.title() + ' Cache')
+
         elif self.request.get('migrate'):
             logging.info('Beginning migration.')
             modified = []
@@ -57,6 +64,10 @@ class DevController(FormController):
             if modified:
                 model.ndb.put_multi(modified)
 
+            # migrations over a lot of entities run in batches as a chain of tasks instead
+            taskqueue.add(url='/job/migrate/auths')
+            taskqueue.add(url='/job/migrate/users')
+
             logging.info('Migration finished. Modified ' + str(len(modified)) + ' items.')
             self.flash('success', 'Migrations Complete')
 
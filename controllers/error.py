@@ -1,14 +1,46 @@
 import logging
 
+import webapp2
+from webapp2_extras import sessions
+
 from base import BaseController
 from config.constants import SUPPORT_EMAIL
+import model
 
 
 class ErrorController(BaseController):
     """ handles any page that falls through the rest of config.ROUTES """
 
+    # rendered once per instance, see `dispatch`
+    NOT_FOUND_BODY = None
+
+    def dispatch(self):
+        # most requests for missing pages come from bots scanning for things like /wp-admin
+        # without a session cookie nobody can be signed in, so the session, user, and template are all skipped
+        config = self.app.config.get('webapp2_extras.sessions', {})
+        cookie_name = config.get('cookie_name', sessions.default_config['cookie_name'])
+        if self.request.method in ('GET', 'HEAD') and cookie_name not in self.request.cookies:
+            model.recordMissingPath(self.request.path)
+            self.response.set_status(404)
+            self.setHeaders()
+            if self.request.method == 'GET':
+                self.response.write(self.notFoundBody())
+        else:
+            super(ErrorController, self).dispatch()
+
+    @classmethod
+    def notFoundBody(cls):
+        if cls.NOT_FOUND_BODY is None:
+            # the same variables as `compileTemplate` for someone who isn't signed in
+            template = cls.jinja_env.get_template('error.html')
+            page_title = "Error 404: " + webapp2.Response.http_status_message(404)
+            cls.NOT_FOUND_BODY = template.render(page_title=page_title, user=None, is_admin=False, is_dev=False,
+                form={}, errors={}, flash={}, csrf='')
+        return cls.NOT_FOUND_BODY
+
     def get(self, invalid_path):
 
+        model.recordMissingPath(self.request.path)
         self.renderError(404)
 
 
@@ -1,16 +1,22 @@
 import base64
+import csv
 from datetime import datetime, timedelta
+import io
 import json
 import logging
+import time
 import urllib2
 
-from google.appengine.api import mail
+from google.appengine.api import images, mail, taskqueue
+from google.appengine.ext import blobstore
 
 from base import BaseController
 from config.constants import SENDGRID_API_KEY, SENDER_EMAIL
 import model
 import helpers
+import sitemap
 
+import cloudstorage as gcs
 import sendgrid
 from sendgrid.helpers import mail as sgmail
 
@@ -22,10 +28,345 @@ class AuthsController(BaseController):
     def get(self):
 
         days_ago = datetime.utcnow() - timedelta(self.MAX_DAYS)
-        auths = model.Auth.query(model.Auth.last_login < days_ago).fetch(keys_only=True)
-        model.ndb.delete_multi(auths)
+        query = model.Auth.query(model.Auth.last_login < days_ago)
 
-        logging.info('Removed ' + str(len(auths)) + ' old auths.')
+        # a batch at a time so that there's never too many in memory
+        deltas = {}
+        count = 0
+        cursor = None
+        more = True
+        while more:
+            keys, cursor, more = query.fetch_page(model.REVOKE_BATCH, keys_only=True, start_cursor=cursor)
+            model.ndb.Future.wait_all(model.deleteAuths(keys, deltas))
+            count += len(keys)
+        model.updateStats(deltas)
+
+        logging.info('Removed ' + str(count) + ' old auths.')
+
+        self.render('OK')
+
+
+class ActivityController(BaseController):
+
+    def get(self):
+
+        modified = model.flushActivity()
+
+        logging.info('Updated ' + str(modified) + ' auths with recent activity.')
+
+        self.render('OK')
+
+
+class ImageController(BaseController):
+
+    IMAGE_READ_BYTES = 1024
+
+    # called internally
+    SKIP_CSRF = True
+
+    def post(self):
+
+        user_key = model.ndb.Key(urlsafe=self.request.get('user_key'))
+        blob_key = blobstore.BlobKey(self.request.get('blob'))
+        gcs_path = self.request.get('gcs')
+
+        # the contents are checked before the images service ever sees them
+        # only the first buffer is read, so a large upload is never pulled into memory
+        try:
+            if gcs_path:
+                f = gcs.open(helpers.gcs_path(gcs_path), read_buffer_size=self.IMAGE_READ_BYTES)
+            else:
+                f = blobstore.BlobReader(blob_key, buffer_size=self.IMAGE_READ_BYTES)
+            try:
+                image = helpers.detect_image(f)
+            finally:
+                f.close()
+        except (gcs.NotFoundError, blobstore.Error):
+            # it was already replaced and deleted
+            image = None
+
+        url = None
+        if image:
+            try:
+                # note that this serving URL supports size and crop query params
+                url = images.get_serving_url(blob_key, secure_url=True)
+            except images.Error:
+                pass
+
+        if not url:
+            values = {'pic_gcs': None, 'pic_blob': None, 'pic_status': model.User.PIC_INVALID}
+            user = model.updatePic(user_key, blob_key, **values)
+            if user:
+                params = {'blob': str(blob_key)}
+                if gcs_path:
+                    params['gcs'] = gcs_path
+                taskqueue.add(url='/job/image/delete', params=params, queue_name='images')
+        else:
+            thumbs = [url + '=s' + str(size) for size in model.User.PIC_SIZES]
+            values = {'pic_url': url, 'pic_thumbs': thumbs, 'pic_status': model.User.PIC_READY}
+            user = model.updatePic(user_key, blob_key, **values)
+            if not user:
+                # the picture was replaced while this was running, so the URL is already unused
+                images.delete_serving_url(blob_key)
+
+        if user:
+            self.uncache(user.slug, namespace=model.CACHE_USERS)
+
+        self.render('OK')
+
+
+class ImageDeleteController(BaseController):
+
+    # called internally
+    SKIP_CSRF = True
+
+    def post(self):
+
+        # blobs are deleted at once rather than one RPC after another, while the GCS files are removed
+        blobs = self.request.get_all('blob')
+        url_rpcs = [images.delete_serving_url_async(blob) for blob in blobs]
+        blob_rpc = blobs and blobstore.delete_async(blobs)
+
+        for path in self.request.get_all('gcs'):
+            try:
+                gcs.delete(helpers.gcs_path(path))
+            except gcs.NotFoundError:
+                # a missing file was already deleted by an earlier attempt
+                pass
+
+        for rpc in url_rpcs:
+            try:
+                rpc.get_result()
+            except images.Error:
+                # not every picture was given a serving URL
+                pass
+
+        if blob_rpc:
+            blob_rpc.get_result()
+
+        self.render('OK')
+
+
+class MigrateAuthsController(BaseController):
+
+    # called internally
+    SKIP_CSRF = True
+
+    def post(self):
+
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = model.ndb.Cursor(urlsafe=self.request.get('cursor'))
+
+        cursor = model.migrateAuths(cursor=cursor)
+        if cursor:
+            taskqueue.add(url='/job/migrate/auths', params={'cursor': cursor.urlsafe()})
+        else:
+            logging.info('Finished migrating auths.')
+
+        self.render('OK')
+
+
+class StatsController(BaseController):
+    """ recounts the stats from scratch in batches, chained across tasks, to correct any drift in the running totals """
+
+    # called internally
+    SKIP_CSRF = True
+
+    def get(self):
+
+        taskqueue.add(url='/job/stats', params={'kind': 'User'})
+
+        self.render('OK')
+
+    def post(self):
+
+        kind = self.request.get('kind')
+        totals = json.loads(self.request.get('totals') or '{}')
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = model.ndb.Cursor(urlsafe=self.request.get('cursor'))
+
+        cursor = model.countStats(kind, totals, cursor=cursor)
+        if cursor:
+            params = {'kind': kind, 'totals': json.dumps(totals), 'cursor': cursor.urlsafe()}
+            taskqueue.add(url='/job/stats', params=params)
+        elif kind == 'User':
+            taskqueue.add(url='/job/stats', params={'kind': 'Auth', 'totals': json.dumps(totals)})
+        else:
+            model.reconcileStats(totals)
+            logging.info('Reconciled stats.')
+
+        self.render('OK')
+
+
+class MigrateUsersController(BaseController):
+
+    # called internally
+    SKIP_CSRF = True
+
+    def post(self):
+
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = model.ndb.Cursor(urlsafe=self.request.get('cursor'))
+
+        cursor = model.migrateUsers(cursor=cursor)
+        if cursor:
+            taskqueue.add(url='/job/migrate/users', params={'cursor': cursor.urlsafe()})
+        else:
+            logging.info('Finished migrating users.')
+
+        self.render('OK')
+
+
+class ExportController(BaseController):
+    """ writes out an export a batch at a time, chaining tasks until it's done
+        rows go straight to GCS and only the writer's unsent buffer is kept, so memory stays flat """
+
+    BATCH = 500
+    # leaves plenty of time before the task deadline to save progress
+    MAX_SECONDS = 60
+    # no task can run longer than its deadline, so by then one holding a lease has died
+    LEASE_SECONDS = 10 * 60
+    # spreadsheets run cells starting with these as formulas, so they're escaped
+    CSV_FORMULA_CHARS = ('=', '+', '-', '@', '\t', '\r')
+
+    # called internally
+    SKIP_CSRF = True
+
+    def post(self):
+
+        export = model.Export.get_by_id(int(self.request.get('export_id')))
+        step = int(self.request.get('step'))
+        # a retried task for a step that already finished has nothing left to do
+        if not export or export.status != model.Export.STARTED or export.step != step:
+            return self.render('OK')
+
+        # a copy of this task that's still running would write the same rows, so this one tries again later
+        export = model.claimExport(export.key, step, self.LEASE_SECONDS)
+        if not export:
+            self.response.set_status(503)
+            return self.render('Busy')
+
+        cls = model.ndb.Model._lookup_model(export.kind)
+        columns = export.columns
+
+        writer = export.writer
+        if not writer:
+            writer = gcs.open(export.gcs_path, 'w', content_type=model.Export.FORMATS[export.format])
+            if export.format == 'csv':
+                writer.write(self.formatRows(export.format, columns, [columns]))
+
+        cursor = None
+        if export.cursor:
+            cursor = model.ndb.Cursor(urlsafe=export.cursor)
+
+        # each task writes at least one batch
+        started = time.time()
+        while True:
+            entities, cursor, more = cls.query().fetch_page(self.BATCH, start_cursor=cursor)
+            rows = [[self.formatValue(entity.key)] + [self.formatValue(getattr(entity, name)) for name in columns[1:]]
+                for entity in entities]
+            writer.write(self.formatRows(export.format, columns, rows))
+            export.count += len(rows)
+
+            if not more or time.time() - started >= self.MAX_SECONDS:
+                break
+
+        if more and cursor:
+            export.writer = writer
+            export.cursor = cursor.urlsafe()
+            export.step += 1
+            model.saveExport(export)
+        else:
+            writer.close()
+            export.writer = None
+            export.cursor = None
+            export.leased_until = None
+            export.status = model.Export.FINISHED
+            export.put()
+
+            logging.info('Exported ' + str(export.count) + ' ' + export.kind + ' entities.')
+            self.deferEmail([export.email], "Export Finished", "export.html", host=export.host_url, export=export)
+
+        self.render('OK')
+
+    def formatValue(self, value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, model.ndb.Key):
+            return value.urlsafe()
+        if isinstance(value, blobstore.BlobKey):
+            return str(value)
+        return value
+
+    def formatRows(self, export_format, columns, rows):
+        if export_format == 'csv':
+            out = io.BytesIO()
+            writer = csv.writer(out)
+            for row in rows:
+                writer.writerow([self.csvValue(value) for value in row])
+            return out.getvalue()
+
+        lines = [json.dumps(dict(zip(columns, row)), ensure_ascii=False) for row in rows]
+        return ''.join(line.encode('utf-8') + '\n' for line in lines)
+
+    def csvValue(self, value):
+        # the csv module only handles byte strings, and lists are written as JSON
+        if isinstance(value, list):
+            value = json.dumps(value)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if isinstance(value, str) and value.startswith(self.CSV_FORMULA_CHARS):
+            value = "'" + value
+        return value
+
+
+class RevokeController(BaseController):
+
+    # called internally
+    SKIP_CSRF = True
+
+    def post(self):
+
+        user_key = model.ndb.Key(urlsafe=self.request.get('user_key'))
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = model.ndb.Cursor(urlsafe=self.request.get('cursor'))
+        except_key = None
+        if self.request.get('except_key'):
+            except_key = model.ndb.Key(urlsafe=self.request.get('except_key'))
+
+        self.revokeAuths(user_key, except_key=except_key, cursor=cursor)
+
+        self.render('OK')
+
+
+class SitemapController(BaseController):
+
+    # called internally
+    SKIP_CSRF = True
+
+    def get(self):
+
+        # a new sitemap can only be built once the base URL is configured or learned from a request
+        sitemap.startBuild()
+
+        self.render('OK')
+
+    def post(self):
+
+        # each step writes one shard and then queues the next
+        state = model.Sitemap.getState()
+        generation = int(self.request.get('generation'))
+        shard = int(self.request.get('shard'))
+
+        # a newer build has replaced this one, or this step has already run
+        if state.building == generation and state.build_shards == shard:
+            sitemap.buildShard(state)
+            if not state.building:
+                logging.info('Finished building sitemap with ' + str(state.shards) + ' shards.')
 
         self.render('OK')
 
@@ -1,12 +1,198 @@
-from base import BaseController, cacheAndRender
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from google.appengine.api import app_identity, taskqueue
+
+from base import BaseController
+from config.constants import BASE_URL
+import model
+
+import cloudstorage as gcs
+
+# sitemaps can only have a max of 50,000 URLs or be 10 MB each, so they're split up well below that
+SHARD_SIZE = 10000
+INDEX_CACHE_KEY = 'sitemap_index'
+
+# each source is a function that takes a cursor (None to start from the beginning) and a limit
+# and returns a tuple of (entries, next cursor or None when there's no more)
+# where each entry is a tuple of (path, priority) - priority is relative and ranges from 0.0 to 1.0
+SOURCES = OrderedDict()
+
+
+def registerSource(name, source):
+    """ controllers or models call this to have their URLs included in the sitemap """
+    SOURCES[name] = source
+
+
+def querySource(query, toEntry):
+    """ makes a source out of a datastore query, `toEntry` turns each result into a (path, priority) tuple """
+    def source(cursor, limit):
+        start_cursor = cursor and model.ndb.Cursor(urlsafe=cursor) or None
+        results, next_cursor, more = query.fetch_page(limit, start_cursor=start_cursor)
+        return [toEntry(result) for result in results], more and next_cursor and next_cursor.urlsafe() or None
+    return source
+
+
+PAGES = [
+    ('/', 1.0),
+    ('/user/signup', 0.2),
+    ('/user/login', 0.2),
+    ('/user/forgotpassword', 0.0),
+    ('/terms', 0.0),
+    ('/privacy', 0.0)
+]
+
+registerSource('pages', lambda cursor, limit: (PAGES, None))
+
+
+def shardPath(generation, shard):
+    return '/' + app_identity.get_default_gcs_bucket_name() + '/sitemaps/' + str(generation) + '/' + str(shard) + '.xml'
+
+
+def needsBaseURL(sitemap):
+    # the configured URL always wins, since a request's host is whatever the client sent
+    return not sitemap.base_url or BASE_URL and sitemap.base_url != BASE_URL
+
+
+@model.ndb.transactional
+def startBuild(host_url=None):
+    """ starts generating a new set of shards, the current ones keep being served until it's done
+        pass the host of a request to learn the base URL from it, which only ever happens once
+        returns the state, or None if there's no base URL to build with yet """
+    # `get_or_insert` is a transaction of its own, so it can't be used in this one
+    sitemap = model.Sitemap.get_by_id(model.Sitemap.STATE_ID) or model.Sitemap(id=model.Sitemap.STATE_ID)
+    if host_url and not needsBaseURL(sitemap):
+        # another request got here first
+        return sitemap
+
+    sitemap.base_url = BASE_URL or sitemap.base_url or host_url
+    if not sitemap.base_url:
+        return None
+
+    building = sitemap.building
+    sitemap.building = int(time.time())
+    sitemap.build_shards = 0
+    sitemap.build_source = 0
+    sitemap.build_cursor = None
+    saveBuild(sitemap, building)
+    return sitemap
+
+
+def buildShard(sitemap):
+    """ writes the next shard of a build, pulling from each source in turn """
+    names = SOURCES.keys()
+    entries = []
+    while len(entries) < SHARD_SIZE and sitemap.build_source < len(names):
+        source = SOURCES[names[sitemap.build_source]]
+        found, cursor = source(sitemap.build_cursor, SHARD_SIZE - len(entries))
+        entries.extend(found)
+        if cursor:
+            sitemap.build_cursor = cursor
+        else:
+            sitemap.build_source += 1
+            sitemap.build_cursor = None
+
+    if entries:
+        template = BaseController.jinja_env.get_template('sitemap.xml')
+        path = shardPath(sitemap.building, sitemap.build_shards)
+        with gcs.open(path, 'w', content_type='application/xml') as f:
+            for chunk in template.generate(base_url=sitemap.base_url, entries=entries):
+                f.write(chunk.encode('utf-8'))
+        sitemap.build_shards += 1
+
+    if sitemap.build_source < len(names):
+        saveBuild(sitemap, sitemap.building)
+    else:
+        finishBuild(sitemap)
+
+
+@model.ndb.transactional
+def saveBuild(sitemap, building):
+    # the next step is only queued if this one is saved, so a retry can never run the same step twice
+    if not saveIfCurrent(sitemap, building):
+        return
+    params = {'generation': sitemap.building, 'shard': sitemap.build_shards}
+    taskqueue.add(url='/job/sitemap', params=params, transactional=True)
+
+
+@model.ndb.transactional
+def saveIfCurrent(sitemap, building):
+    """ saves the state only if the build being saved over is still `building`, returns whether it was saved
+        otherwise a step of a build that's since been replaced would undo the new one """
+    current = sitemap.key.get()
+    if current and current.building != building:
+        return False
+    sitemap.put()
+    return True
+
+
+def finishBuild(sitemap):
+    old_generation = sitemap.generation
+    old_shards = sitemap.shards
+    building = sitemap.building
+
+    sitemap.generation = sitemap.building
+    sitemap.shards = sitemap.build_shards
+    sitemap.generated_date = datetime.utcnow()
+    sitemap.building = None
+    sitemap.build_cursor = None
+    if not saveIfCurrent(sitemap, building):
+        return
+
+    model.uncache(INDEX_CACHE_KEY, namespace=model.CACHE_PAGES)
+
+    # crawlers might still be reading the old files, but only briefly since the index pointed at them
+    for shard in xrange(old_shards):
+        try:
+            gcs.delete(shardPath(old_generation, shard))
+        except gcs.NotFoundError:
+            pass
 
 
 class SitemapController(BaseController):
-    """ handles generating a sitemap """
+    """ serves the sitemap index, which points at each of the shards that were generated in the background """
 
-    @cacheAndRender()
     def get(self):
-        # FYI: sitemaps can only have a max of 50,000 URLs or be 10 MB each
-        base_url = "http://" + self.request.headers.get("host")
+        self.response.headers['Content-Type'] = 'application/xml'
+
+        # the state is only needed when the cached index has to be rendered again
+        index = model.getCache(INDEX_CACHE_KEY, namespace=model.CACHE_PAGES)
+        if index is None:
+            sitemap = model.Sitemap.getState()
+            if needsBaseURL(sitemap):
+                # shards are generated by a task, so they need to know where to send crawlers
+                sitemap = startBuild(self.request.host_url)
+
+            index = self.renderIndex(sitemap)
+            # the first one hasn't finished yet, so this isn't cached
+            if sitemap.generation:
+                model.setCache(INDEX_CACHE_KEY, index, namespace=model.CACHE_PAGES)
+
+        self.render(index)
+
+    def renderIndex(self, sitemap):
+        template = self.jinja_env.get_template('sitemap_index.xml')
+        return template.render(base_url=sitemap.base_url, shards=xrange(sitemap.shards),
+            generated_date=sitemap.generated_date)
+
+
+class SitemapShardController(BaseController):
+
+    def get(self, shard):
+        sitemap = model.Sitemap.getState()
+        shard = int(shard)
+        if shard >= sitemap.shards:
+            return self.renderError(404)
+
+        try:
+            with gcs.open(shardPath(sitemap.generation, shard)) as f:
+                content = f.read()
+        except gcs.NotFoundError:
+            # an old generation can be deleted out from under a request that read the state just before
+            return self.renderError(404)
 
-        self.renderTemplate('sitemap.xml', base_url=base_url)
+        self.response.headers['Content-Type'] = 'application/xml'
+        # these only change once a day, so let them be cached outside the app
+        self.response.headers['Cache-Control'] = 'public, max-age=3600'
+        self.render(content)
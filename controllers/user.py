@@ -1,52 +1,64 @@
 from datetime import datetime
 
-from google.appengine.api import images
-from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 
-from base import BaseController, FormController, withUser, withoutUser, testDispatch
+from base import BaseController, Field, FormController, withUser, withoutUser, testDispatch
+import helpers
 import model
+from ratelimit import Limit
 
-import cloudstorage as gcs
 from gae_validators import validateRequiredString, validateRequiredEmail, validateBool
-import httpagentparser
 
 IMAGE_TYPES = ["gif", "jpg", "jpeg", "png"]
 SESSION_MAX_AGE = 86400 * 14 # two weeks in seconds
 
+# note that emails are supposed to be case sensitive according to RFC 5321
+# however in practice users consistenly expect them to be case insensitive
+EMAIL_FIELD = Field(validateRequiredEmail, normalize=lambda email: email.lower())
+# never send passwords back for security
+PASSWORD_FIELD = Field(validateRequiredString, sensitive=True)
+
 
 class BaseLoginController(FormController):
 
-    def login(self, user, new=False, remember=False):
+    def checkClient(self):
+        """ returns the client's user agent and IP address, or None after redirecting away if either is missing """
         ua = self.request.headers.get('User-Agent', '')
         ip = self.request.remote_addr or ''
 
         # reject a login attempt without a user agent or IP address
         if not ua or not ip:
             self.flash('error', 'Invalid client.')
-            return self.redirect("/user/login")
-
-        auth = None
-        if not new:
+            self.redirect("/user/login")
+            return None
+        return ua, ip
+
+    def login(self, user, new=False, remember=False, auth=None):
+        """ a new user is saved here along with their first auth, so check the client first before making one
+            pass in the auth if it's already been fetched to skip looking it up again """
+        client = self.checkClient()
+        if not client:
+            return
+        ua, ip = client
+
+        if not new and not auth:
             auth = user.getAuth(ua)
 
         if auth:
-            # note that this triggers the last login auto update
-            auth.ip = ip
-            auth.put()
+            # the last login and IP are written later along with other activity instead of right now
+            model.recordActivity(auth.key.urlsafe(), ip)
         else:
-            parsed = httpagentparser.detect(ua)
-            os = browser = device = ''
-            if 'os' in parsed:
-                # shows up as Linux for Android, Mac OS for iOS
-                os = parsed['os']['name']
-            if 'browser' in parsed:
-                browser = parsed['browser']['name']
-            if 'dist' in parsed:
-                # "dist" stands for "distribution" - like Android, iOS
-                device = parsed['dist']['name']
-            auth = model.Auth(user_agent=ua, os=os, browser=browser, device=device, ip=ip, parent=user.key)
-            auth.put()
+            os, browser, device = helpers.parse_user_agent(ua)
+            auth = model.Auth(key=model.Auth.keyFor(user.key, ua), user_agent=ua, os=os, browser=browser,
+                device=device, ip=ip)
+            if new:
+                # the auth is in the user's entity group, so they're both saved with a single RPC
+                # if only the user were saved they could still log in, so this doesn't need a transaction
+                model.ndb.put_multi([user, auth])
+                model.updateStats(model.addStats(model.userStats(user), model.authStats(auth)))
+            else:
+                auth.put()
+                model.updateStats(model.authStats(auth))
 
         cookie_args = self.session_store.config['cookie_args']
         if remember:
@@ -83,19 +95,7 @@ class IndexController(blobstore_handlers.BlobstoreUploadHandler, FormController)
             if not self.checkCSRF():
                 return self.renderError(412)
 
-            if self.user.pic_gcs:
-                path = self.user.pic_gcs
-                if path.startswith('/gs/'):
-                    path = path[3:]
-                gcs.delete(path)
-            if self.user.pic_url:
-                images.delete_serving_url(self.user.pic_blob)
-            if self.user.pic_blob:
-                blobstore.delete(self.user.pic_blob)
-
-            self.user.pic_gcs = None
-            self.user.pic_blob = None
-            self.user.pic_url = None
+            self.changePic(self.user)
         else:
             errors = {}
             uploads = self.get_uploads()
@@ -108,38 +108,57 @@ class IndexController(blobstore_handlers.BlobstoreUploadHandler, FormController)
                     errors = {'type': True}
                     continue
 
-                try:
-                    # note that this serving URL supports size and crop query params
-                    self.user.pic_url = images.get_serving_url(upload, secure_url=True)
-                except images.TransformationError:
-                    upload.delete()
-                    errors = {'corrupt': True}
-                    continue
-
-                self.user.pic_gcs = upload.gs_object_name
-                self.user.pic_blob = upload.key()
+                # the image is checked and its serving URLs are made by a task, see `job.ImageController`
+                self.changePic(self.user, upload.gs_object_name, upload.key())
 
             if errors:
                 return self.redisplay({}, errors)
 
-        self.user.put()
-        self.uncache(self.user.slug)
         self.redisplay()
 
 
 class AuthsController(FormController):
 
+    PAGE_SIZE = 20
+    # only what the page displays is read, straight out of the index (see index.yaml)
+    PROJECTION = ['last_login', 'browser', 'device', 'ip', 'os']
+
     @withUser
     def get(self):
 
-        auths = self.user.auths
+        cursor = None
+        str_cursor = self.request.get('cursor')
+        if str_cursor:
+            try:
+                cursor = model.ndb.Cursor(urlsafe=str_cursor)
+            except Exception:
+                # an invalid cursor just starts back at the first page
+                pass
+
+        auths, next_cursor, more = self.user.auths.fetch_page(self.PAGE_SIZE, start_cursor=cursor,
+            projection=self.PROJECTION)
+
+        # the user agent isn't indexed, so it's only fetched for the rare auths it couldn't be parsed for
+        unparsed = [auth.key for auth in auths if not (auth.device or auth.os or auth.browser)]
+        user_agents = dict((auth.key, auth.user_agent) for auth in model.ndb.get_multi(unparsed) if auth)
+
+        # the key string is used more than once per row, so it's only made once
+        rows = [(auth, auth.key.urlsafe(), user_agents.get(auth.key)) for auth in auths]
+        next_cursor = more and next_cursor and next_cursor.urlsafe() or None
         current_auth_key = self.session['auth_key']
 
-        self.renderTemplate('user/auths.html', auths=auths, current_auth_key=current_auth_key)
+        self.renderTemplate('user/auths.html', rows=rows, current_auth_key=current_auth_key,
+            next_cursor=next_cursor, is_first_page=cursor is None)
 
     @withUser
     def post(self):
 
+        if self.request.get('others'):
+            current_auth_key = model.ndb.Key(urlsafe=self.session['auth_key'])
+            self.revokeAuths(self.user.key, except_key=current_auth_key)
+            self.flash('success', 'Access revoked for all other sessions.')
+            return self.redisplay()
+
         str_key = self.request.get('auth_key')
 
         try:
@@ -152,8 +171,7 @@ class AuthsController(FormController):
             if auth_key.parent() != self.user.key:
                 return self.renderError(403)
             else:
-                self.uncache(str_key)
-                auth_key.delete()
+                model.deleteAuth(str_key)
                 self.flash('success', 'Access revoked.')
 
         self.redisplay()
@@ -161,7 +179,7 @@ class AuthsController(FormController):
 
 class EmailController(FormController):
 
-    FIELDS = {"email": validateRequiredEmail, "password": validateRequiredString}
+    FIELDS = {"email": EMAIL_FIELD, "password": PASSWORD_FIELD}
 
     @withUser
     def get(self):
@@ -179,20 +197,16 @@ class EmailController(FormController):
 
         # extra validation to make sure that email address isn't already in use
         if not errors:
-            # note that emails are supposed to be case sensitive according to RFC 5321
-            # however in practice users consistenly expect them to be case insensitive
-            email = valid_data["email"].lower()
-            user = model.User.getByEmail(email)
+            user = model.User.getByEmail(valid_data["email"])
             if user:
                 errors["exists"] = True
 
         if errors:
-            del form_data["password"] # never send password back for security
             self.redisplay(form_data, errors)
         else:
-            self.user.email = email
+            self.user.email = valid_data["email"]
             self.user.put()
-            self.uncache(self.user.slug)
+            self.uncache(self.user.slug, namespace=model.CACHE_USERS)
 
             self.flash("success", "Email changed successfully.")
             self.redirect("/user")
@@ -200,7 +214,7 @@ class EmailController(FormController):
 
 class PasswordController(FormController):
 
-    FIELDS = {"password": validateRequiredString, "new_password": validateRequiredString}
+    FIELDS = {"password": PASSWORD_FIELD, "new_password": PASSWORD_FIELD}
 
     @withUser
     def get(self):
@@ -217,15 +231,13 @@ class PasswordController(FormController):
             errors["match"] = True
 
         if errors:
-            del form_data["password"]
-            del form_data["new_password"]
             self.redisplay(form_data, errors)
         else:
             password_salt, hashed_password = model.User.changePassword(valid_data["new_password"])
 
             self.user.populate(password_salt=password_salt, hashed_password=hashed_password)
             self.user.put()
-            self.uncache(self.user.slug)
+            self.uncache(self.user.slug, namespace=model.CACHE_USERS)
 
             self.flash("success", "Password changed successfully.")
             self.redirect("/user")
@@ -233,11 +245,13 @@ class PasswordController(FormController):
 
 class SignupController(BaseLoginController):
 
+    RATE_LIMITS = [Limit('ip', 10, 3600)]
+
     FIELDS = {
         "first_name": validateRequiredString,
         "last_name": validateRequiredString,
-        "email": validateRequiredEmail,
-        "password": validateRequiredString
+        "email": EMAIL_FIELD,
+        "password": PASSWORD_FIELD
     }
 
     @withoutUser
@@ -250,28 +264,36 @@ class SignupController(BaseLoginController):
 
         form_data, errors, valid_data = self.validate()
 
+        # the new user is only saved once they're logged in, so a client that can't be is turned away first
+        if not errors and not self.checkClient():
+            return
+
         # extra validation to make sure that email address isn't already in use
         if not errors:
-            valid_data["email"] = valid_data["email"].lower()
-            user = model.User.getByEmail(valid_data["email"])
-            if user:
+            # the new user's ID doesn't depend on the check, so it's reserved at the same time
+            user_future = model.User.getByEmailAsync(valid_data["email"])
+            ids_future = model.User.allocate_ids_async(1)
+            if user_future.get_result():
                 errors["exists"] = True
 
         if errors:
-            del form_data["password"] # never send password back for security
             self.redisplay(form_data, errors)
         else:
             password_salt, hashed_password = model.User.changePassword(valid_data["password"])
             del valid_data["password"]
-            user = model.User(password_salt=password_salt, hashed_password=hashed_password, **valid_data)
-            user.put()
+            user_id, _ = ids_future.get_result()
+            user = model.User(id=user_id, password_salt=password_salt, hashed_password=hashed_password,
+                **valid_data)
             self.flash("success", "Thank you for signing up!")
             self.login(user, new=True)
 
 
 class LoginController(BaseLoginController):
 
-    FIELDS = {"email": validateRequiredEmail, "password": validateRequiredString, "remember": validateBool}
+    # guessing passwords is slowed down for each account as well as each client
+    RATE_LIMITS = [Limit('ip', 20, 60), Limit('email', 10, 60)]
+
+    FIELDS = {"email": EMAIL_FIELD, "password": PASSWORD_FIELD, "remember": validateBool}
 
     @withoutUser
     def get(self):
@@ -284,9 +306,11 @@ class LoginController(BaseLoginController):
         form_data, errors, valid_data = self.validate()
 
         # check that the user exists and the password matches
-        user = None
+        user = auth = None
         if not errors:
-            user = model.User.getByEmail(valid_data["email"].lower())
+            # the auth for this device is fetched in the same tasklet as soon as the user is found
+            ua = self.request.headers.get('User-Agent', '')
+            user, auth = model.User.getWithAuthAsync(valid_data["email"], ua).get_result()
             if user:
                 hashed_password = model.User.hashPassword(valid_data["password"], user.password_salt)
                 if hashed_password != user.hashed_password:
@@ -297,31 +321,29 @@ class LoginController(BaseLoginController):
                 errors["match"] = True
 
         if errors:
-            del form_data["password"] # never send password back for security
             self.redisplay(form_data, errors)
         else:
-            self.login(user, remember=valid_data["remember"])
+            self.login(user, remember=valid_data["remember"], auth=auth)
 
 
 class LogoutController(BaseController):
 
     @withUser
     def post(self):
-        str_key = self.session['auth_key']
-        try:
-            auth_key = model.ndb.Key(urlsafe=str_key)
-        except Exception:
-            pass
+        if self.request.get('everywhere'):
+            self.revokeAuths(self.user.key)
         else:
-            self.uncache(str_key)
-            auth_key.delete()
+            model.deleteAuth(self.session['auth_key'])
         self.session.clear()
         self.redirect("/")
 
 
 class ForgotPasswordController(FormController):
 
-    FIELDS = {"email": validateRequiredEmail}
+    # every request sends an email
+    RATE_LIMITS = [Limit('ip', 10, 3600), Limit('email', 3, 3600)]
+
+    FIELDS = {"email": EMAIL_FIELD}
 
     @withoutUser
     def get(self):
@@ -337,7 +359,7 @@ class ForgotPasswordController(FormController):
             self.redisplay(form_data, errors)
         else:
             # for security, don't alert them if the user doesn't exist
-            user = model.User.getByEmail(valid_data["email"].lower())
+            user = model.User.getByEmail(valid_data["email"])
             if user:
                 user = user.resetPassword()
                 self.deferEmail([user.email], "Reset Password", "reset_password.html",
@@ -351,7 +373,10 @@ class ForgotPasswordController(FormController):
 
 class ResetPasswordController(BaseLoginController):
 
-    FIELDS = {"key": validateRequiredString, "token": validateRequiredString, "password": validateRequiredString}
+    # even showing the form checks the token
+    RATE_LIMITS = [Limit('ip', 20, 60, methods=('GET', 'POST'))]
+
+    FIELDS = {"key": validateRequiredString, "token": validateRequiredString, "password": PASSWORD_FIELD}
 
     @withoutUser
     def before(self):
@@ -389,6 +414,6 @@ class ResetPasswordController(BaseLoginController):
             self.user.put()
 
             # need to uncache so that changes to the user object get picked up by memcache
-            self.uncache(self.key)
+            self.uncache(self.key, namespace=model.CACHE_USERS)
             self.flash("success", "Your password has been changed. You have been logged in with your new password.")
             self.login(self.user)
@@ -1,11 +1,17 @@
 import os
 import re
+import struct
 from urllib import quote_plus
 
 from google.appengine.api import memcache, users
 
+from lru import LRUCache
+import model
+
 from lib.gae_deploy import static, script, style, DEBUG # NOQA: F401
 
+import httpagentparser
+
 TESTING = '(testbed)' in os.environ.get('SERVER_SOFTWARE', '')
 
 
@@ -113,13 +119,109 @@ def int_comma(i):
 
 
 def get_cache(key):
-    value = memcache.get(key)
     # don't use cached versions in development or for admins
-    if value and not debug() and not users.is_current_user_admin():
-        return value
-    return None
+    # this check comes first so that they never take the lease to refresh a stale page
+    if debug() or users.is_current_user_admin():
+        return None
+    return model.getCache(key, namespace=model.CACHE_PAGES)
 
 
 def store_cache(key, value, expires=86400): # cache for 1 day by default
     if not users.is_current_user_admin(): # don't cache the admin version of a page
-        memcache.add(key, value, expires)
+        model.setCache(key, value, expires, namespace=model.CACHE_PAGES)
+
+
+# the same few hundred user agents show up over and over, so parsing them is cached in process and in memcache
+USER_AGENTS = LRUCache(1000)
+USER_AGENT_PREFIX = 'useragent:'
+
+
+def parse_user_agent(ua):
+    # returns a tuple of the (os, browser, device) for a user agent string
+    key = model.hashUserAgent(ua)
+    parsed = USER_AGENTS.get(key)
+    if parsed is None:
+        parsed = memcache.get(USER_AGENT_PREFIX + key)
+        if parsed is None:
+            parsed = detect_user_agent(ua)
+            memcache.add(USER_AGENT_PREFIX + key, parsed)
+        USER_AGENTS.set(key, parsed)
+    return parsed
+
+
+def detect_user_agent(ua):
+    parsed = httpagentparser.detect(ua)
+    os_name = browser = device = ''
+    if 'os' in parsed:
+        # shows up as Linux for Android, Mac OS for iOS
+        os_name = parsed['os']['name']
+    if 'browser' in parsed:
+        browser = parsed['browser']['name']
+    if 'dist' in parsed:
+        # "dist" stands for "distribution" - like Android, iOS
+        device = parsed['dist']['name']
+    return os_name, browser, device
+
+
+# the first few bytes of a GIF or PNG hold its size, a JPEG's is found by skipping from segment to segment
+IMAGE_HEADER_BYTES = 24
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+JPEG_MAX_SEGMENTS = 100
+
+
+def gcs_path(gs_object_name):
+    # blobstore uploads name GCS objects like "/gs/bucket/object", but the client library leaves off the "/gs"
+    if gs_object_name.startswith('/gs/'):
+        gs_object_name = gs_object_name[3:]
+    return gs_object_name
+
+
+def detect_image(f):
+    # takes a file-like object and only reads as much as it needs to find the real format and dimensions
+    # returns a tuple of (format, width, height) or None if it isn't a supported image
+    head = f.read(IMAGE_HEADER_BYTES)
+    image = None
+    if head[:6] in ('GIF87a', 'GIF89a') and len(head) >= 10:
+        width, height = struct.unpack('<HH', head[6:10])
+        image = 'gif', width, height
+    elif head[:8] == '\x89PNG\r\n\x1a\n' and head[12:16] == 'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        image = 'png', width, height
+    elif head[:2] == '\xff\xd8':
+        image = _detect_jpeg(f)
+    if image and image[1] and image[2]:
+        return image
+    return None
+
+
+def _detect_jpeg(f):
+    f.seek(2)
+    for i in xrange(JPEG_MAX_SEGMENTS):
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            return None
+        code = ord(marker[1])
+        # markers can be padded with any number of fill bytes
+        while code == 0xFF:
+            fill = f.read(1)
+            if not fill:
+                return None
+            code = ord(fill)
+
+        # the start of scan or end of image comes after the frame header in a valid file
+        if code in (0xD9, 0xDA):
+            return None
+
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+
+        if code in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return 'jpeg', width, height
+
+        f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+    return None
@@ -0,0 +1,31 @@
+# kept apart from helpers so that model can use it too, since helpers imports model
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ a thread safe, in process cache that drops the least recently used values once it's full """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.pop(key, None)
+            if value is not None:
+                # move it back to the end as the most recently used
+                self.values[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = value
+            if len(self.values) > self.size:
+                self.values.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
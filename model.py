@@ -1,15 +1,42 @@
 import base64
+import cPickle as pickle
+import hmac
 import os
-from datetime import datetime
-from hashlib import sha512
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from hashlib import sha1, sha256, sha512
 
-from google.appengine.api import memcache
+from google.appengine.api import memcache, taskqueue
 from google.appengine.ext import ndb
 
 from config.constants import PASSWORD_PEPPER
+from lru import LRUCache
+
+# users can be searched for by the start of any word in their name or email, see `User.search`
+SEARCH_SPLIT = re.compile(r'[\s@.+_-]+', re.UNICODE)
+SEARCH_PREFIX_MAX = 20
+SEARCH_WORDS_MAX = 5
 
 
 class User(ndb.Model):
+    # bump this whenever a property changes how it stores values so that old cached copies are ignored
+    CACHE_VERSION = 1
+
+    # thumbnails are generated in these sizes (in pixels) once a picture has been processed
+    PIC_SIZES = [50, 100, 200]
+    PIC_PROCESSING = 'processing'
+    PIC_READY = 'ready'
+    PIC_INVALID = 'invalid'
+
+    # what's included when a user is sent to an API client
+    API_FIELDS = ['first_name', 'last_name', 'email', 'pic_url', 'pic_thumbs', 'created_date']
+    # what's never included in an export, see `Export`
+    EXPORT_EXCLUDE = ['password_salt', 'hashed_password', 'token', 'token_date', 'search_tokens']
+
     first_name = ndb.StringProperty(required=True)
     last_name = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
@@ -20,8 +47,16 @@ class User(ndb.Model):
     pic_gcs = ndb.StringProperty()
     pic_blob = ndb.BlobKeyProperty()
     pic_url = ndb.StringProperty()
+    pic_status = ndb.StringProperty(indexed=False)
+    # serving URLs in the same order as `PIC_SIZES`
+    pic_thumbs = ndb.StringProperty(repeated=True, indexed=False)
     is_admin = ndb.BooleanProperty(default=False)
     created_date = ndb.DateTimeProperty(auto_now_add=True)
+    # lowercase prefixes of each word in the name and email, kept up to date on every save
+    search_tokens = ndb.StringProperty(repeated=True)
+
+    def _pre_put_hook(self):
+        self.search_tokens = searchTokens(self.first_name, self.last_name, self.email)
 
     @property
     def slug(self):
@@ -31,9 +66,40 @@ class User(ndb.Model):
     def auths(self):
         return Auth.query(ancestor=self.key).order(-Auth.last_login)
 
+    @property
+    def pic_thumbnails(self):
+        return dict(zip(self.PIC_SIZES, self.pic_thumbs))
+
     @classmethod
     def getByEmail(cls, email):
-        return cls.query(cls.email == email).get()
+        return cls.getByEmailAsync(email).get_result()
+
+    @classmethod
+    def getByEmailAsync(cls, email):
+        return cls.query(cls.email == email).get_async()
+
+    @classmethod
+    @ndb.tasklet
+    def getWithAuthAsync(cls, email, user_agent):
+        """ gets the user for an email along with their auth for a user agent, if they have one """
+        user = yield cls.getByEmailAsync(email)
+        auth = None
+        if user:
+            auth = yield Auth.keyFor(user.key, user_agent).get_async()
+        raise ndb.Return((user, auth))
+
+    @classmethod
+    def search(cls, text=None, start=None, end=None):
+        """ returns a query for users matching the start of every word in `text` (up to a limit)
+            and created within the dates if they're given, with the newest first """
+        query = cls.query()
+        for word in searchWords(text)[:SEARCH_WORDS_MAX]:
+            query = query.filter(cls.search_tokens == word[:SEARCH_PREFIX_MAX])
+        if start:
+            query = query.filter(cls.created_date >= start)
+        if end:
+            query = query.filter(cls.created_date < end)
+        return query.order(-cls.created_date)
 
     @classmethod
     def hashPassword(cls, password, salt):
@@ -46,36 +112,177 @@ class User(ndb.Model):
         return salt, hashed_password
 
     def getAuth(self, user_agent):
-        return Auth.query(Auth.user_agent == user_agent, ancestor=self.key).get()
+        return getByKey(Auth.keyFor(self.key, user_agent).urlsafe())
 
     def resetPassword(self):
         # python b64 always ends in '==' so we remove them because this is for use in a URL
         self.token = base64.urlsafe_b64encode(os.urandom(16)).replace('=', '')
         self.token_date = datetime.utcnow()
         self.put()
-        uncache(self.slug)
+        uncache(self.slug, namespace=CACHE_USERS)
         return self
 
 
 class Auth(ndb.Model):
-    user_agent = ndb.StringProperty(required=True)
+    CACHE_VERSION = 1
+    API_FIELDS = ['os', 'browser', 'device', 'ip', 'first_login', 'last_login']
+    EXPORT_EXCLUDE = ['token_hash']
+
+    # auths are looked up by their key instead, see `keyFor`
+    user_agent = ndb.StringProperty(required=True, indexed=False)
     os = ndb.StringProperty(required=True)
     browser = ndb.StringProperty(required=True)
     device = ndb.StringProperty(required=True)
     ip = ndb.StringProperty(required=True)
     first_login = ndb.DateTimeProperty(auto_now_add=True)
-    last_login = ndb.DateTimeProperty(auto_now=True)
+    # kept up to date by `flushActivity` rather than on every request
+    last_login = ndb.DateTimeProperty(auto_now_add=True)
+    # only the hash of an API token is stored, see `issueToken`
+    token_hash = ndb.StringProperty(indexed=False)
 
     @property
     def user(self):
         return self.key.parent().get()
 
+    @classmethod
+    def keyFor(cls, user_key, user_agent):
+        # each user has one auth per user agent, so it can be fetched directly instead of queried
+        return ndb.Key(cls, hashUserAgent(user_agent), parent=user_key)
+
+
+class Upload(ndb.Model):
+    """ a resumable upload that goes straight to GCS instead of through the app, see `api.UploadSessionsController` """
+    STARTED = 'started'
+    FINISHED = 'finished'
+
+    gcs_path = ndb.StringProperty(required=True, indexed=False)
+    # the client sends chunks here, and it can be asked how much has arrived so far
+    session_url = ndb.StringProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(required=True, indexed=False)
+    status = ndb.StringProperty(default=STARTED, indexed=False)
+    created_date = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class Sitemap(ndb.Model):
+    """ there's only one of these, it keeps track of the sitemap being served and the next one being built """
+    STATE_ID = 'sitemap'
+
+    # configured, or learned from the first request for the sitemap, see `sitemap.startBuild`
+    base_url = ndb.StringProperty(indexed=False)
+    # shard files are stored under a different path for each generation, see `sitemap.shardPath`
+    generation = ndb.IntegerProperty(default=0, indexed=False)
+    shards = ndb.IntegerProperty(default=0, indexed=False)
+    generated_date = ndb.DateTimeProperty(indexed=False)
+    # progress of the build that's underway, if there is one
+    building = ndb.IntegerProperty(indexed=False)
+    build_shards = ndb.IntegerProperty(default=0, indexed=False)
+    build_source = ndb.IntegerProperty(default=0, indexed=False)
+    build_cursor = ndb.StringProperty(indexed=False)
+
+    @classmethod
+    def getState(cls):
+        return cls.get_or_insert(cls.STATE_ID)
+
+
+class Export(ndb.Model):
+    """ a file with every entity of a kind that's written to GCS a batch at a time, see `job.ExportController` """
+    STARTED = 'started'
+    FINISHED = 'finished'
+
+    KINDS = ['User', 'Auth']
+    # maps each format to its content type
+    FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+    kind = ndb.StringProperty(required=True, indexed=False)
+    format = ndb.StringProperty(required=True, indexed=False)
+    gcs_path = ndb.StringProperty(required=True, indexed=False)
+    # who's emailed a link once it's done, and where the link points
+    email = ndb.StringProperty(required=True, indexed=False)
+    host_url = ndb.StringProperty(required=True, indexed=False)
+    status = ndb.StringProperty(default=STARTED, indexed=False)
+    # each task in the chain is a step, so that a retried one that already finished can be ignored
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    # the GCS writer is saved between tasks, which only holds what hasn't been sent to GCS yet
+    writer = ndb.PickleProperty(compressed=True)
+    # while a task is writing a step no other copy of it can, see `claimExport`
+    leased_until = ndb.DateTimeProperty(indexed=False)
+    created_date = ndb.DateTimeProperty(auto_now_add=True)
+
+    @property
+    def filename(self):
+        return self.kind.lower() + 's-' + self.created_date.strftime('%Y-%m-%d') + '.' + self.format
+
+    @property
+    def columns(self):
+        cls = ndb.Model._lookup_model(self.kind)
+        return ['key'] + [name for name in sorted(cls._properties) if name not in cls.EXPORT_EXCLUDE]
+
+
+class StatsShard(ndb.Model):
+    """ running totals are split across several of these so that updating them doesn't contend, see `updateStats` """
+    # maps each stat's name to this shard's part of its total
+    counts = ndb.JsonProperty(default={})
+
+
+@ndb.transactional
+def updatePic(user_key, blob_key, **values):
+    """ sets picture values on a user only if that picture hasn't been replaced since, returns the user if it was """
+    user = user_key.get()
+    if user and user.pic_blob == blob_key:
+        user.populate(**values)
+        user.put()
+        return user
+
+
+@ndb.transactional
+def saveExport(export):
+    """ saves an export along with a task for its next step, which is only queued if the export is saved """
+    export.leased_until = None
+    export.put()
+    params = {'export_id': export.key.id(), 'step': export.step}
+    taskqueue.add(url='/job/export', params=params, transactional=True)
+
+
+@ndb.transactional
+def claimExport(export_key, step, seconds):
+    """ leases a step of an export to the current task, returns the export or None if it can't be done now
+        a lease that runs out means whoever held it died, so the step can be taken over """
+    export = export_key.get()
+    now = datetime.utcnow()
+    if (not export or export.status != Export.STARTED or export.step != step
+            or export.leased_until and export.leased_until > now):
+        return None
+    export.leased_until = now + timedelta(seconds=seconds)
+    export.put()
+    return export
+
+
+def searchWords(text):
+    return text and [word for word in SEARCH_SPLIT.split(text.lower()) if word] or []
+
+
+def searchTokens(*texts):
+    tokens = set()
+    for text in texts:
+        for word in searchWords(text):
+            for i in xrange(1, min(len(word), SEARCH_PREFIX_MAX) + 1):
+                tokens.add(word[:i])
+    return sorted(tokens)
+
+
+def hashUserAgent(user_agent):
+    return sha1(user_agent.encode('utf-8')).hexdigest()
+
 
 # model helper functions
 def getByKey(str_key):
     entity = None
     if str_key:
-        entity = memcache.get(str_key)
+        cache_key = cacheKey(str_key, CACHE_USERS)
+        cached = _memcacheGet(cache_key)
+        entity = decodeEntity(cached)
         if not entity:
             try:
                 key = ndb.Key(urlsafe=str_key)
@@ -84,17 +291,654 @@ def getByKey(str_key):
             else:
                 entity = key.get()
                 if entity:
-                    memcache.add(str_key, entity)
+                    if cached is None:
+                        _memcacheAdd(cache_key, encodeEntity(entity))
+                    else:
+                        # an outdated copy is still there, which would block adding a new one
+                        _memcacheStore(cache_key, encodeEntity(entity))
+    return entity
+
+
+# API tokens are the auth's key and a secret, so the auth can be fetched directly without a query
+TOKEN_SEPARATOR = '.'
+# verified tokens are kept in memory this long, so a revoked token can still work on an instance until then
+TOKEN_CACHE_SECONDS = 10
+# maps each token to its auth and when it stops being trusted
+_tokens = LRUCache(1000)
+
+
+def hashToken(secret):
+    # secrets are long and random, so unlike passwords they don't need a salt or a slow hash
+    return sha256(secret).hexdigest()
+
+
+def issueToken(auth):
+    """ gives an auth a new API token, replacing any it had before, and returns it - the token itself isn't stored """
+    secret = base64.urlsafe_b64encode(os.urandom(32)).replace('=', '')
+    auth.token_hash = hashToken(secret)
+    auth.put()
+    uncache(auth.key.urlsafe(), namespace=CACHE_USERS)
+    return auth.key.urlsafe() + TOKEN_SEPARATOR + secret
+
+
+def tokenKeys(token):
+    """ returns the string keys of a token's auth and user so they can be prefetched, or None if it's malformed """
+    str_key = token.partition(TOKEN_SEPARATOR)[0]
+    try:
+        key = ndb.Key(urlsafe=str_key)
+    except Exception:
+        return None
+    if key.kind() != Auth._get_kind() or not key.parent():
+        return None
+    return str_key, key.parent().urlsafe()
+
+
+def getByToken(token):
+    """ returns the auth for an API token, or None if it's invalid or has been revoked """
+    now = time.time()
+    cached = _tokens.get(token)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    str_key, _, secret = token.partition(TOKEN_SEPARATOR)
+    if not secret or not tokenKeys(token):
+        return None
+
+    auth = getByKey(str_key)
+    if not auth or not auth.token_hash or not hmac.compare_digest(str(auth.token_hash), hashToken(secret)):
+        return None
+
+    _tokens.set(token, (auth, now + TOKEN_CACHE_SECONDS))
+    return auth
+
+
+# auths are deleted this many at a time, and a single request stops after REVOKE_LIMIT
+REVOKE_BATCH = 200
+REVOKE_LIMIT = 1000
+
+
+def revokeAuths(user_key, except_key=None, cursor=None, limit=REVOKE_LIMIT):
+    """ deletes all of a user's auths except for one, returns a cursor to continue from if it stopped early """
+    query = Auth.query(ancestor=user_key)
+    keys = query.iter(keys_only=True, batch_size=REVOKE_BATCH, start_cursor=cursor, produce_cursors=True)
+
+    futures = []
+    batch = []
+    deltas = {}
+    count = 0
+    for key in keys:
+        count += 1
+        if key != except_key:
+            batch.append(key)
+
+        if len(batch) >= REVOKE_BATCH or count >= limit:
+            futures.extend(deleteAuths(batch, deltas))
+            batch = []
+
+        if count >= limit:
+            break
+
+    futures.extend(deleteAuths(batch, deltas))
+    ndb.Future.wait_all(futures)
+    updateStats(deltas)
+
+    if count >= limit and keys.has_next():
+        return keys.cursor_after()
+    return None
+
+
+def deleteAuths(keys, deltas):
+    """ starts deleting a batch of auths and returns the futures, adding them to `deltas` to update the stats with
+        the auths are read by key for their stats, so this works with a keys only query that needs no extra index """
+    for auth in ndb.get_multi(keys):
+        if auth:
+            addStats(deltas, authStats(auth, -1))
+    return _revokeBatch(keys)
+
+
+def deleteAuth(str_key):
+    """ deletes a single auth and takes it out of the stats """
+    auth = getByKey(str_key)
+    if isinstance(auth, Auth):
+        uncache(str_key, namespace=CACHE_USERS)
+        auth.key.delete()
+        updateStats(authStats(auth, -1))
+
+
+def _revokeBatch(keys):
+    if not keys:
+        return []
+    # like `uncache` this keeps the deleted auths from being cached again right away
+    memcache.delete_multi([cacheKey(key.urlsafe(), CACHE_USERS) for key in keys], seconds=10)
+    return ndb.delete_multi_async(keys)
+
+
+MIGRATE_BATCH = 200
+
+
+def migrateAuths(cursor=None, limit=MIGRATE_BATCH):
+    """ moves auths with numeric IDs over to keys based on their user agent, returns a cursor if there are more """
+    auths, cursor, more = Auth.query().fetch_page(limit, start_cursor=cursor)
+
+    # several old auths can have the same user agent, and one might already have a new key, so keep the latest
+    old_auths = [auth for auth in auths if auth.key.integer_id()]
+    new_auths = {}
+    for auth in old_auths:
+        new_key = Auth.keyFor(auth.key.parent(), auth.user_agent)
+        if new_key not in new_auths or new_auths[new_key].last_login < auth.last_login:
+            new_auths[new_key] = Auth(key=new_key, **auth.to_dict())
+
+    existing_auths = ndb.get_multi(new_auths.keys())
+    for existing_auth in existing_auths:
+        if existing_auth and existing_auth.last_login >= new_auths[existing_auth.key].last_login:
+            del new_auths[existing_auth.key]
+
+    ndb.put_multi(new_auths.values())
+    ndb.Future.wait_all(_revokeBatch([auth.key for auth in old_auths]))
+
+    return more and cursor or None
+
+
+def migratedAuthKey(str_key, user_agent):
+    """ returns where an auth with an old numeric key was moved by `migrateAuths`, or None if it wasn't one """
+    try:
+        key = ndb.Key(urlsafe=str_key)
+    except Exception:
+        return None
+    if key.kind() != Auth._get_kind() or not key.integer_id() or not user_agent:
+        return None
+    return Auth.keyFor(key.parent(), user_agent).urlsafe()
+
+
+def migrateUsers(cursor=None, limit=MIGRATE_BATCH):
+    """ saves users again so that their search tokens are filled in, returns a cursor if there are more """
+    users, cursor, more = User.query().fetch_page(limit, start_cursor=cursor)
+    ndb.put_multi(users)
+    return more and cursor or None
+
+
+# models with a CACHE_VERSION are cached as a tuple of their values instead of a pickled model instance
+# anything over this many bytes is compressed too
+COMPRESS_BYTES = 1024
+CODEC_PLAIN = 'p'
+CODEC_COMPRESSED = 'z'
+
+# maps each model class to its cache version and the properties it stores, in order
+_codecs = {}
+
+
+def getCodec(cls):
+    codec = _codecs.get(cls)
+    if not codec:
+        properties = [cls._properties[name] for name in sorted(cls._properties)]
+        # adding, removing, or renaming a property changes the version on its own
+        names = ','.join(prop._name for prop in properties)
+        version = str(cls.CACHE_VERSION) + '.' + str(zlib.crc32(names) & 0xffffffff)
+        codec = _codecs[cls] = (version, properties)
+    return codec
+
+
+def encodeEntity(entity):
+    cls = type(entity)
+    if not hasattr(cls, 'CACHE_VERSION'):
+        return entity
+
+    version, properties = getCodec(cls)
+    values = tuple(prop._get_user_value(entity) for prop in properties)
+    key = entity.key
+    data = pickle.dumps((cls._get_kind(), version, key.flat(), key.namespace(), values), pickle.HIGHEST_PROTOCOL)
+
+    if len(data) > COMPRESS_BYTES:
+        return CODEC_COMPRESSED + zlib.compress(data)
+    return CODEC_PLAIN + data
+
+
+def decodeEntity(cached):
+    """ returns the entity from a cached value, or None if it's missing or was stored by an old version """
+    if not isinstance(cached, str):
+        # entities without a codec are stored as is
+        return cached if isinstance(cached, ndb.Model) and not hasattr(cached, 'CACHE_VERSION') else None
+
+    codec, data = cached[:1], cached[1:]
+    if codec == CODEC_COMPRESSED:
+        data = zlib.decompress(data)
+    elif codec != CODEC_PLAIN:
+        return None
+
+    kind, version, flat, namespace, values = pickle.loads(data)
+    cls = ndb.Model._lookup_model(kind)
+    cls_version, properties = getCodec(cls)
+    if version != cls_version:
+        return None
+
+    entity = cls(key=ndb.Key(flat=flat, namespace=namespace))
+    # the values came straight from an entity, so this skips re-validating them
+    for prop, value in zip(properties, values):
+        prop._store_value(entity, value)
     return entity
 
 
-def cache(key, function, expires=86400):
-    value = memcache.get(key)
+# cache namespaces that can each be invalidated all at once by bumping their generation
+CACHE_PAGES = 'pages'
+CACHE_USERS = 'users'
+CACHE_NAMESPACES = [CACHE_PAGES, CACHE_USERS]
+GENERATION_PREFIX = 'generation:'
+# how long an instance trusts its copy of a generation before checking memcache for a new one
+GENERATION_SECONDS = 5
+
+# maps each namespace to its generation and when that was last fetched
+_generations = {}
+
+
+def getGeneration(namespace):
+    now = time.time()
+    generation, fetched = _generations.get(namespace, (None, 0))
+    if generation is None or fetched + GENERATION_SECONDS <= now:
+        key = GENERATION_PREFIX + namespace
+        generation = _memcacheGet(key)
+        if generation is None:
+            # start from the current time so that an evicted counter never returns to an old generation
+            generation = int(now)
+            if not memcache.add(key, generation):
+                generation = memcache.get(key) or generation
+        _generations[namespace] = (generation, now)
+    return generation
+
+
+def invalidateCache(namespace):
+    """ invalidates every entry in the namespace at once by moving on to a new generation """
+    now = time.time()
+    generation = memcache.incr(GENERATION_PREFIX + namespace, initial_value=int(now))
+    _generations[namespace] = (generation, now)
+    return generation
+
+
+def cacheKey(key, namespace=None):
+    if namespace:
+        key = namespace + ':' + str(getGeneration(namespace)) + ':' + key
+    return key
+
+
+class CacheBatch(object):
+    """ collects the cache reads and writes made during a request to cut down on RPCs
+        keys marked with `prefetch` are fetched along with the first read, and every write is sent when it's flushed
+        any other read costs an RPC of its own, like the page cache whose keys aren't known until the action runs """
+
+    def __init__(self):
+        self.pending = set() # keys that will be fetched by the next read
+        self.values = {} # keys that have already been fetched, including misses
+        self.writes = {} # maps (method, expires) to the values that need to be written that way
+        self.releases = set() # keys that will be deleted after the writes
+
+    def prefetch(self, keys):
+        self.pending.update(key for key in keys if key not in self.values)
+
+    def get(self, key):
+        if key not in self.values:
+            self.pending.add(key)
+            keys = list(self.pending)
+            values = memcache.get_multi(keys)
+            for pending_key in keys:
+                self.values[pending_key] = values.get(pending_key)
+            self.pending.clear()
+        return self.values[key]
+
+    def add(self, key, value, expires=0):
+        self.writes.setdefault(('add', expires), {})[key] = value
+        if self.values.get(key) is None:
+            self.values[key] = value
+
+    def store(self, key, value, expires=0):
+        # adds the value or replaces one that's already there, see `setCache`
+        self.writes.setdefault(('store', expires), {})[key] = value
+        self.values[key] = value
+
+    def release(self, key):
+        self.releases.add(key)
+
+    def delete(self, key, seconds=0):
+        # deletes happen right away because they invalidate what other requests can see
+        for mapping in self.writes.values():
+            mapping.pop(key, None)
+        self.values.pop(key, None)
+        memcache.delete(key, seconds=seconds)
+
+    def flush(self):
+        for (method, expires), mapping in self.writes.items():
+            if mapping:
+                failed = memcache.add_multi(mapping, time=expires)
+                if failed and method == 'store':
+                    memcache.replace_multi(dict((key, mapping[key]) for key in failed), time=expires)
+        self.writes = {}
+
+        if self.releases:
+            memcache.delete_multi(list(self.releases))
+            self.releases = set()
+
+
+# each request gets its own batch, see `BaseController.dispatch`
+_local = threading.local()
+
+
+def startBatch():
+    _local.batch = CacheBatch()
+    return _local.batch
+
+
+def endBatch():
+    batch = getattr(_local, 'batch', None)
+    _local.batch = None
+    if batch:
+        batch.flush()
+
+
+def prefetch(keys, namespace=None):
+    """ marks keys that will be needed later in this request so they're all fetched together """
+    batch = getattr(_local, 'batch', None)
+    if batch:
+        batch.prefetch([cacheKey(key, namespace) for key in keys if key])
+
+
+def _memcacheGet(key):
+    batch = getattr(_local, 'batch', None)
+    if batch:
+        return batch.get(key)
+    return memcache.get(key)
+
+
+def _memcacheAdd(key, value, expires=0):
+    batch = getattr(_local, 'batch', None)
+    if batch:
+        batch.add(key, value, expires)
+    else:
+        memcache.add(key, value, expires)
+
+
+def _memcacheStore(key, value, expires=0):
+    batch = getattr(_local, 'batch', None)
+    if batch:
+        batch.store(key, value, expires)
+    elif not memcache.add(key, value, expires):
+        memcache.replace(key, value, expires)
+
+
+def _memcacheRelease(key):
+    batch = getattr(_local, 'batch', None)
+    if batch:
+        batch.release(key)
+    else:
+        memcache.delete(key)
+
+
+def _memcacheDelete(key, seconds=0):
+    batch = getattr(_local, 'batch', None)
+    if batch:
+        batch.delete(key, seconds)
+    else:
+        memcache.delete(key, seconds=seconds)
+
+
+# activity is recorded in memcache and then written to each Auth in batches by `flushActivity`
+ACTIVITY_PREFIX = 'activity:'
+# auths are spread across this many indexes so that they don't all increment the same counter
+ACTIVITY_SHARDS = 20
+# activity is grouped into windows this many seconds long, and an auth is only recorded once per window
+ACTIVITY_WINDOW = 60
+# how many windows back a flush looks for ones that haven't been written yet
+ACTIVITY_WINDOWS_MAX = 60
+ACTIVITY_BATCH = 500
+
+
+def activityMarker(str_key, window=None):
+    if window is None:
+        window = int(time.time()) // ACTIVITY_WINDOW
+    return ACTIVITY_PREFIX + str(window) + ':' + str_key
+
+
+def recordActivity(str_key, ip):
+    """ notes that an auth was just used, without writing to the datastore """
+    window = int(time.time()) // ACTIVITY_WINDOW
+    marker = activityMarker(str_key, window)
+    expires = ACTIVITY_WINDOW * (ACTIVITY_WINDOWS_MAX + 1)
+
+    # the marker is usually prefetched, so an auth that's already been recorded in this window costs nothing
+    if _memcacheGet(marker) or not memcache.add(marker, 1, expires):
+        return False
+
+    _memcacheStore(ACTIVITY_PREFIX + str_key, (datetime.utcnow(), ip), expires)
+
+    # register the auth in its shard's index for this window so the flush can find it
+    index_key = ACTIVITY_PREFIX + str(window) + ':' + str(zlib.crc32(str_key) % ACTIVITY_SHARDS)
+    # created with an expiry first, since `incr` would make one that's never removed
+    memcache.add(index_key, 0, expires)
+    index = memcache.incr(index_key)
+    if index:
+        _memcacheStore(index_key + ':' + str(index), str_key, expires)
+    return True
+
+
+def flushActivity():
+    """ writes recorded activity to the auths, returns how many were modified
+        a window is only flushed after the next one has ended, so the writes to it are finished too """
+    current = int(time.time()) // ACTIVITY_WINDOW
+    flushed = memcache.get(ACTIVITY_PREFIX + 'flushed') or 0
+    windows = range(max(flushed + 1, current - ACTIVITY_WINDOWS_MAX), current - 1)
+    if not windows:
+        return 0
+
+    index_keys = [ACTIVITY_PREFIX + str(window) + ':' + str(shard)
+        for window in windows for shard in range(ACTIVITY_SHARDS)]
+    counts = memcache.get_multi(index_keys)
+    slot_keys = [index_key + ':' + str(index)
+        for index_key, count in counts.items() for index in range(1, int(count) + 1)]
+    str_keys = list(set(memcache.get_multi(slot_keys).values()))
+
+    modified = 0
+    for i in range(0, len(str_keys), ACTIVITY_BATCH):
+        batch_keys = str_keys[i:i + ACTIVITY_BATCH]
+        activity = memcache.get_multi(batch_keys, key_prefix=ACTIVITY_PREFIX)
+        futures = [(str_key, _flushAuth(ndb.Key(urlsafe=str_key), *activity[str_key]))
+            for str_key in batch_keys if str_key in activity]
+
+        changed = [str_key for str_key, future in futures if future.get_result()]
+        if changed:
+            memcache.delete_multi([cacheKey(str_key, CACHE_USERS) for str_key in changed])
+            modified += len(changed)
+
+    memcache.set(ACTIVITY_PREFIX + 'flushed', windows[-1])
+    return modified
+
+
+@ndb.transactional_tasklet
+def _flushAuth(key, last_login, ip):
+    # each auth is read and written in its own transaction, so one that's revoked meanwhile isn't brought back
+    auth = yield key.get_async()
+    if not auth or auth.last_login and last_login <= auth.last_login:
+        raise ndb.Return(False)
+    auth.populate(last_login=last_login, ip=ip)
+    yield auth.put_async()
+    raise ndb.Return(True)
+
+
+# only a sample of requests for missing paths are counted, and only the most common paths are kept
+MISSING_KEY = 'missing_paths'
+MISSING_SAMPLE_RATE = 10
+MISSING_MAX = 100
+MISSING_PATH_LENGTH = 200
+MISSING_RETRIES = 3
+
+
+def recordMissingPath(path):
+    """ counts about one in every `MISSING_SAMPLE_RATE` requests for a path that doesn't exist """
+    if random.randint(1, MISSING_SAMPLE_RATE) != 1:
+        return False
+
+    path = path[:MISSING_PATH_LENGTH]
+    client = memcache.Client()
+    for i in xrange(MISSING_RETRIES):
+        counts = client.gets(MISSING_KEY)
+        if counts is None:
+            if client.add(MISSING_KEY, {path: 1}):
+                return True
+            continue
+
+        if path in counts:
+            counts[path] += 1
+        elif len(counts) < MISSING_MAX:
+            counts[path] = 1
+        else:
+            # the least common path makes way, and its count is kept so that a new one can work its way up
+            least = min(counts, key=counts.get)
+            counts[path] = counts.pop(least) + 1
+
+        if client.cas(MISSING_KEY, counts):
+            return True
+    return False
+
+
+def getMissingPaths(limit=20):
+    """ returns a list of (path, estimated requests) tuples for the most requested missing paths """
+    counts = memcache.get(MISSING_KEY) or {}
+    top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [(path, count * MISSING_SAMPLE_RATE) for path, count in top]
+
+
+# running totals for the admin page, so that it never has to scan users or auths
+# they're reconciled with a full count each night, see `job.StatsController`
+# all the shards are updated together when reconciling, so there can't be more than a transaction allows (25)
+STATS_SHARDS = 20
+STATS_CACHE_KEY = 'stats'
+STATS_CACHE_SECONDS = 60
+# signups are counted for each of this many days
+STATS_DAYS = 30
+STATS_BATCH = 500
+STATS_PROJECTION = ['browser', 'device', 'os']
+
+
+def userStats(user, delta=1):
+    stats = {'users': delta}
+    day = user.created_date.date()
+    if (datetime.utcnow().date() - day).days < STATS_DAYS:
+        stats['signups:' + day.isoformat()] = delta
+    return stats
+
+
+def authStats(auth, delta=1):
+    return {'auths': delta, 'browser:' + auth.browser: delta, 'device:' + auth.device: delta, 'os:' + auth.os: delta}
+
+
+def addStats(totals, stats):
+    for name, count in stats.items():
+        totals[name] = totals.get(name, 0) + count
+    return totals
+
+
+def statsKeys():
+    return [ndb.Key(StatsShard, 'shard' + str(i)) for i in xrange(STATS_SHARDS)]
+
+
+def updateStats(deltas):
+    """ adds to the running totals, which costs a single transaction on a random shard no matter how many change """
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if deltas:
+        _updateShard(random.choice(statsKeys()), deltas)
+
+
+@ndb.transactional
+def _updateShard(key, deltas):
+    shard = key.get() or StatsShard(key=key)
+    counts = dict(shard.counts)
+    addStats(counts, deltas)
+    shard.counts = dict((name, count) for name, count in counts.items() if count)
+    shard.put()
+
+
+def getStats():
+    """ returns a dict of each stat's name and its total, which is only a single cache lookup most of the time """
+    return cache(STATS_CACHE_KEY, sumStats, expires=STATS_CACHE_SECONDS)
+
+
+def sumStats():
+    totals = {}
+    for shard in ndb.get_multi(statsKeys()):
+        if shard:
+            addStats(totals, shard.counts)
+    return totals
+
+
+def countStats(kind, totals, cursor=None, limit=STATS_BATCH):
+    """ adds a batch of users or auths to the totals, returns a cursor to continue from if there are more """
+    if kind == 'User':
+        # the user's creation date is read straight out of the built in index
+        query = User.query(projection=['created_date'])
+        toStats = userStats
+    else:
+        query = Auth.query(projection=STATS_PROJECTION)
+        toStats = authStats
+
+    entities, cursor, more = query.fetch_page(limit, start_cursor=cursor)
+    for entity in entities:
+        addStats(totals, toStats(entity))
+    return more and cursor or None
+
+
+def reconcileStats(totals):
+    """ replaces the running totals with a full count, and compacts them into one shard while it's at it
+        anything that changed while the count was being made is off until the next one """
+    _replaceShards(dict((name, count) for name, count in totals.items() if count))
+    uncache(STATS_CACHE_KEY)
+
+
+@ndb.transactional(xg=True)
+def _replaceShards(counts):
+    shards = [StatsShard(key=key) for key in statsKeys()]
+    shards[0].counts = counts
+    ndb.put_multi(shards)
+
+
+# how long past its expiration a value can still be served while one request refreshes it
+STALE_SECONDS = 3600
+# how long a request has to refresh a value before another one is allowed to try
+LEASE_SECONDS = 30
+LEASE_SUFFIX = ':lease'
+
+
+def getCache(key, namespace=None):
+    """ returns the cached value or None if this request should compute it
+        once a value expires exactly one request gets a lease to refresh it and everyone else gets the stale value """
+    key = cacheKey(key, namespace)
+    cached = _memcacheGet(key)
+    if cached is None:
+        return None
+
+    value, soft_expires = cached
+    if soft_expires and soft_expires <= time.time() and memcache.add(key + LEASE_SUFFIX, 1, LEASE_SECONDS):
+        return None
+
+    return value
+
+
+def setCache(key, value, expires=86400, namespace=None):
+    key = cacheKey(key, namespace)
+
+    # values are stored with their soft expiration and kept around a while longer so they can be served stale
+    # an expiration of zero means that it never goes stale, just like memcache itself
+    soft_expires = expires and time.time() + expires or 0
+    hard_expires = expires and expires + STALE_SECONDS or 0
+    cached = (value, soft_expires)
+
+    # add respects the lock left behind by uncache, and replace only overwrites a stale value that's still there
+    _memcacheStore(key, cached, hard_expires)
+    _memcacheRelease(key + LEASE_SUFFIX)
+
+
+def cache(key, function, expires=86400, namespace=None):
+    value = getCache(key, namespace=namespace)
     if value is None:
         value = function()
-        memcache.add(key, value, expires)
+        setCache(key, value, expires, namespace=namespace)
     return value
 
 
-def uncache(key, seconds=10):
-    memcache.delete(key, seconds=seconds)
+def uncache(key, seconds=10, namespace=None):
+    _memcacheDelete(cacheKey(key, namespace), seconds=seconds)
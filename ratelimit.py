@@ -0,0 +1,103 @@
+# limits how often each client can make requests that are expensive to serve, see `BaseController.RATE_LIMITS`
+import math
+import threading
+import time
+from hashlib import sha1
+
+from google.appengine.api import memcache
+
+import webob.util
+
+# older versions of WebOb don't know this status, and webapp2 can't set one without a reason
+webob.util.status_reasons.setdefault(429, 'Too Many Requests')
+
+PREFIX = 'ratelimit:'
+
+# clients that were just turned away are remembered on each instance so their next requests don't need memcache
+BLOCKED_MAX = 1000
+_blocked = {}
+_blocked_lock = threading.Lock()
+
+
+class Limit(object):
+    """ allows `count` requests every `seconds` for each client, identified by `key`
+        which is "ip" for the remote address, "user" for the signed in user, or the name of any request param
+        requests without a value for their key (like when nobody is signed in) aren't limited
+        only the listed HTTP methods are counted, since those are the ones that do the expensive work """
+
+    def __init__(self, key, count, seconds, methods=('POST',)):
+        self.key = key
+        self.count = count
+        self.seconds = seconds
+        self.methods = methods
+
+
+def clientKey(scope, limit, value):
+    # values can be anything a client sends, so they're hashed to fit in a memcache key
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return PREFIX + scope + ':' + limit.key + ':' + str(limit.seconds) + ':' + sha1(value).hexdigest()
+
+
+def block(client, until):
+    with _blocked_lock:
+        if len(_blocked) >= BLOCKED_MAX:
+            now = time.time()
+            for key, blocked_until in _blocked.items():
+                if blocked_until <= now:
+                    del _blocked[key]
+            if len(_blocked) >= BLOCKED_MAX:
+                _blocked.clear()
+        _blocked[client] = until
+
+
+def check(scope, limits, values):
+    """ counts a request against each of the limits, and returns how many seconds until it's allowed or 0 if it is
+        `values` maps each limit's key to the client's value for it
+        the count is a sliding window estimated from the current and previous fixed windows """
+    now = time.time()
+    offsets = {}
+    # counters are created with an expiry first, since `offset_multi` would make ones that are never removed
+    seeds = {}
+    checks = []
+    for limit in limits:
+        value = values.get(limit.key)
+        if not value:
+            continue
+
+        client = clientKey(scope, limit, value)
+        blocked_until = _blocked.get(client, 0)
+        if blocked_until > now:
+            return int(math.ceil(blocked_until - now))
+
+        window = int(now // limit.seconds)
+        current = client + ':' + str(window)
+        previous = client + ':' + str(window - 1)
+        offsets[current] = 1
+        offsets[previous] = 0
+        # each window is still needed while it's the previous one
+        seed = seeds.setdefault(limit.seconds * 2, {})
+        seed[current] = 0
+        seed[previous] = 0
+        checks.append((limit, client, current, previous, (now % limit.seconds) / limit.seconds))
+
+    if not checks:
+        return 0
+
+    # counters that already exist are left alone
+    for seconds, seed in seeds.items():
+        memcache.add_multi(seed, time=seconds)
+
+    # if memcache is unavailable the counts are missing and requests are let through
+    counts = memcache.offset_multi(offsets, key_prefix='', initial_value=0) or {}
+
+    retry_after = 0
+    for limit, client, current, previous, elapsed in checks:
+        # the previous window's requests count less the further into this one we are
+        estimate = (counts.get(previous) or 0) * (1 - elapsed) + (counts.get(current) or 0)
+        if estimate > limit.count:
+            wait = limit.seconds * (1 - elapsed)
+            block(client, now + wait)
+            retry_after = max(retry_after, wait)
+
+    return int(math.ceil(retry_after))
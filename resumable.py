@@ -0,0 +1,35 @@
+# resumable uploads let clients send files straight to GCS, see `api.UploadSessionsController`
+# the cloudstorage library uses them for its own writes but doesn't expose the session URL a client needs
+# so this is the only place that reaches into its internals, and the first to check when upgrading it
+import urlparse
+
+from cloudstorage import api_utils, errors, storage_api
+
+
+def _api():
+    # retries are left to the client, who can always ask for the progress again
+    return storage_api._get_storage_api(retry_params=None)
+
+
+def startUpload(path, content_type, size):
+    """ starts a resumable upload of a GCS object and returns the session URL to send the file to """
+    # GCS rejects anything bigger than what was asked for
+    headers = {'x-goog-resumable': 'start', 'content-type': content_type,
+        'x-goog-content-length-range': '0,' + str(size)}
+    status, resp_headers, content = _api().post_object(api_utils._quote_filename(path), headers=headers)
+    errors.check_status(status, [201], path, headers=headers, resp_headers=resp_headers, body=content)
+    return resp_headers['location']
+
+
+def uploadProgress(path, session_url):
+    """ asks GCS how far along a resumable upload is, returns a tuple of (complete, bytes received) """
+    path_with_token = api_utils._quote_filename(path) + '?' + urlparse.urlparse(session_url).query
+    headers = {'content-range': 'bytes */*'}
+    status, resp_headers, content = _api().put_object(path_with_token, headers=headers)
+    errors.check_status(status, [200, 201, 308], path, headers=headers, resp_headers=resp_headers, body=content)
+    if status != 308:
+        return True, None
+
+    # this looks like "bytes=0-1234", and is left out when nothing has arrived yet
+    received = resp_headers.get('range')
+    return False, received and int(received.rsplit('-', 1)[1]) + 1 or 0
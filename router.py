@@ -0,0 +1,107 @@
+# matches routes without testing every regex in order like webapp2 does by default
+import re
+import urllib
+
+import webapp2
+
+# characters that only have their literal meaning in a regex when escaped
+REGEX_SPECIAL = set('.^$*+?{}[]|()\\')
+ALTERNATION = re.compile(r'(?<!\\)\|')
+
+
+def literalPrefix(template):
+    """ returns the part of a route template that can only match itself, and whether that's the whole template """
+    if template.startswith('^'):
+        template = template[1:]
+    if template.endswith('$') and not template.endswith('\\$'):
+        template = template[:-1]
+    if ALTERNATION.search(template):
+        # any of the alternatives could match, so nothing is certain
+        return '', False
+
+    prefix = []
+    i = 0
+    while i < len(template):
+        char = template[i]
+        if char == '\\' and i + 1 < len(template) and not template[i + 1].isalnum():
+            # an escaped character like "\." is a literal
+            prefix.append(template[i + 1])
+            i += 2
+        elif char in REGEX_SPECIAL:
+            # anything after this could match more than one thing, and a quantifier applies to what came before
+            if char in '*+?{' and prefix:
+                prefix.pop()
+            return ''.join(prefix), False
+        else:
+            prefix.append(char)
+            i += 1
+    return ''.join(prefix), True
+
+
+class Router(webapp2.Router):
+    """ static routes are found with a dict lookup, and the rest by walking a trie of their literal prefixes
+        when more than one route could match a path they're still tried in the order they were added """
+
+    def __init__(self, routes=None):
+        self.exact_routes = {}
+        self.trie = {}
+        # routes that aren't simple regexes are always tried
+        self.other_routes = []
+        super(Router, self).__init__(routes)
+
+    def add(self, route):
+        start = len(self.match_routes)
+        super(Router, self).add(route)
+        for index in xrange(start, len(self.match_routes)):
+            self.index(index, self.match_routes[index])
+
+    def index(self, index, route):
+        if not isinstance(route, webapp2.SimpleRoute):
+            self.other_routes.append((index, route))
+            return
+
+        prefix, is_literal = literalPrefix(route.template)
+        if is_literal:
+            # the first route added for a path wins, same as matching in order
+            self.exact_routes.setdefault(prefix, (index, route))
+        else:
+            node = self.trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append((index, route))
+
+    def candidates(self, path):
+        found = list(self.other_routes)
+        exact = self.exact_routes.get(path)
+        if exact:
+            found.append(exact)
+
+        node = self.trie
+        found.extend(node.get(None, []))
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            found.extend(node.get(None, []))
+
+        found.sort()
+        return found
+
+    def default_matcher(self, request):
+        path = urllib.unquote(request.path)
+        method_not_allowed = False
+        for index, route in self.candidates(path):
+            try:
+                match = route.match(request)
+                if match:
+                    return match
+            except webapp2.exc.HTTPMethodNotAllowed:
+                method_not_allowed = True
+
+        if method_not_allowed:
+            raise webapp2.exc.HTTPMethodNotAllowed()
+
+        raise webapp2.exc.HTTPNotFound()
+
+    # the base class sets this to its own version
+    match = default_matcher
@@ -81,6 +81,24 @@ for (var i=0; i < gaescaffold.upload_forms.length; i++) {
     gaescaffold.upload_forms[i].addEventListener('submit', gaescaffold.upload);
 }
 
+gaescaffold.poll_pic = function(el) {
+    // reloads the page once a newly uploaded picture has finished processing
+    gaescaffold.ajax('GET', el.getAttribute("data-url"), null, function(response) {
+        var response_json = JSON.parse(response);
+        if (response_json.status == "processing") {
+            setTimeout(function() {gaescaffold.poll_pic(el);}, 2000);
+        }
+        else {
+            window.location.reload();
+        }
+    });
+};
+
+gaescaffold.pic_processing = document.getElementById("pic-processing");
+if (gaescaffold.pic_processing) {
+    setTimeout(function() {gaescaffold.poll_pic(gaescaffold.pic_processing);}, 2000);
+}
+
 gaescaffold.error_name = document.getElementById("error-name");
 if (gaescaffold.error_name) {
     var reason = gaescaffold.error_name.textContent || gaescaffold.error_name.innerText;
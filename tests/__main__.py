@@ -52,18 +52,30 @@ def unit():
     unittest.TextTestRunner(verbosity=2).run(suite)
 
 
+def bench():
+    # benchmarks are written like tests, but they're slow so they only run when asked for
+    print 'Running benchmarks...'
+    loader = unittest.loader.TestLoader()
+    suite = loader.discover('tests', pattern='bench*.py')
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    print 'Benchmarks complete.'
+
+
 if __name__ == "__main__":
     # parse command line arguments
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-l', '--lint', action='store_true', help='only run the linter')
     group.add_argument('-u', '--unit', action='store_true', help='only run unit tests')
+    group.add_argument('-b', '--bench', action='store_true', help='only run benchmarks')
     args = parser.parse_args()
 
     if args.lint:
         lint()
     elif args.unit:
         unit()
+    elif args.bench:
+        bench()
     else:
         lint()
         unit()
@@ -1,5 +1,6 @@
 import base64
 import os
+import time
 import unittest
 
 from google.appengine.ext import testbed
@@ -30,6 +31,8 @@ class BaseTestCase(unittest.TestCase):
         self.testbed.init_taskqueue_stub(root_path=APP_PATH)
         self.task_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
         self.testbed.init_mail_stub()
+        # cloud storage is stubbed out through urlfetch
+        self.testbed.init_urlfetch_stub()
         self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
 
         import model
@@ -75,8 +78,30 @@ class BaseTestCase(unittest.TestCase):
 
         return user
 
-    def createAuth(self, user):
-        auth = self.model.Auth(user_agent='test user agent' + UCHAR, os='test os' + UCHAR,
-            browser='test browser' + UCHAR, device='test device' + UCHAR, ip='127.0.0.1', parent=user.key)
+    def createAuth(self, user, user_agent=None):
+        # each user agent gets its own auth, so make a new one each time unless told otherwise
+        self.auth_count = getattr(self, 'auth_count', 0) + 1
+        user_agent = user_agent or 'test user agent ' + str(self.auth_count) + UCHAR
+        auth = self.model.Auth(key=self.model.Auth.keyFor(user.key, user_agent), user_agent=user_agent,
+            os='test os' + UCHAR, browser='test browser' + UCHAR, device='test device' + UCHAR, ip='127.0.0.1')
         auth.put()
         return auth
+
+
+class BaseBenchCase(BaseTestCase):
+    """ benchmarks use the same stubs and fixtures as tests, but report how long things take """
+
+    ROUNDS = 1000
+
+    def timeit(self, function, rounds=None):
+        # returns the average number of seconds a single call takes
+        rounds = rounds or self.ROUNDS
+        start = time.time()
+        for i in xrange(rounds):
+            function()
+        return (time.time() - start) / rounds
+
+    def report(self, name, value, unit='us'):
+        if unit == 'us':
+            value *= 1000000
+        print '\n    {0}: {1:.2f} {2}'.format(name, value, unit),
@@ -0,0 +1,22 @@
+import json
+
+from base import BaseBenchCase, UCHAR
+
+
+class BenchAPI(BaseBenchCase):
+
+    def setUp(self):
+        super(BenchAPI, self).setUp()
+        from controllers import api
+
+        self.user = self.createUser(first_name='Test' + UCHAR)
+        self.auths = [self.createAuth(self.user, 'Test UA ' + str(i)) for i in xrange(100)]
+        self.encoder = api.APIController.ENCODER
+        self.plain = json.JSONEncoder(ensure_ascii=False, default=api.encodeDefault)
+
+    def test_encode(self):
+        data = {'items': self.auths}
+        assert json.loads(self.encoder.encode(data)) == json.loads(self.plain.encode(data))
+
+        self.report('encode auths', self.timeit(lambda: self.encoder.encode(data)))
+        self.report('encode auths (stdlib)', self.timeit(lambda: self.plain.encode(data)))
@@ -0,0 +1,44 @@
+import cPickle as pickle
+
+from base import BaseBenchCase
+
+
+class BenchEntityCodec(BaseBenchCase):
+
+    def setUp(self):
+        super(BenchEntityCodec, self).setUp()
+        user = self.createUser()
+        auth = self.createAuth(user)
+        self.entities = [user, auth]
+
+    def test_size(self):
+        for entity in self.entities:
+            pickled = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+            encoded = self.model.encodeEntity(entity)
+
+            name = entity.__class__.__name__
+            self.report(name + ' pickled', len(pickled), unit='bytes')
+            self.report(name + ' encoded', len(encoded), unit='bytes')
+            assert len(encoded) < len(pickled)
+
+    def test_decode(self):
+        for entity in self.entities:
+            pickled = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+            encoded = self.model.encodeEntity(entity)
+
+            pickled_time = self.timeit(lambda: pickle.loads(pickled))
+            encoded_time = self.timeit(lambda: self.model.decodeEntity(encoded))
+
+            name = entity.__class__.__name__
+            self.report(name + ' unpickled', pickled_time)
+            self.report(name + ' decoded', encoded_time)
+            assert self.model.decodeEntity(encoded) == entity
+
+    def test_encode(self):
+        for entity in self.entities:
+            pickled_time = self.timeit(lambda: pickle.dumps(entity, pickle.HIGHEST_PROTOCOL))
+            encoded_time = self.timeit(lambda: self.model.encodeEntity(entity))
+
+            name = entity.__class__.__name__
+            self.report(name + ' pickled', pickled_time)
+            self.report(name + ' encoded', encoded_time)
@@ -0,0 +1,27 @@
+from base import BaseBenchCase, UCHAR
+
+
+class BenchForms(BaseBenchCase):
+
+    def setUp(self):
+        super(BenchForms, self).setUp()
+        from app import app
+        from controllers import user
+
+        # the same fields and data as a sign up
+        data = {
+            "first_name": "Test first name" + UCHAR,
+            "last_name": "Test last name" + UCHAR,
+            "email": "Test" + UCHAR + "@example.com",
+            "password": "Test password" + UCHAR
+        }
+        request = app.request_class.blank('/user/signup', POST=dict([(k, v.encode('utf-8')) for k, v in data.items()]))
+
+        self.controller = user.SignupController()
+        self.controller.initialize(request, app.response_class())
+
+    def test_validate(self):
+        form_data, errors, valid_data = self.controller.validate()
+        assert not errors
+
+        self.report('validate signup', self.timeit(self.controller.validate))
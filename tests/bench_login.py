@@ -0,0 +1,77 @@
+import os
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from webtest import TestApp
+
+from base import BaseBenchCase, UCHAR
+
+HEADERS = {'USER_AGENT': 'Test Python UA'}
+ENVIRON = {'REMOTE_ADDR': '127.0.0.1'}
+
+
+class RPCTrace(object):
+    """ records every API call made while it's active, with how long each one took """
+
+    def __init__(self):
+        self.calls = []
+        self.started = {}
+
+    def before(self, service, call, request, response):
+        self.started[id(response)] = time.time()
+
+    def after(self, service, call, request, response):
+        elapsed = time.time() - self.started.pop(id(response), time.time())
+        self.calls.append((service + '.' + call, elapsed))
+
+    def __enter__(self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('trace', self.before)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('trace', self.after)
+        return self
+
+    def __exit__(self, *args):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Clear()
+
+    def report(self):
+        for name, elapsed in self.calls:
+            print '\n    {0}: {1:.2f} ms'.format(name, elapsed * 1000),
+        datastore = [name for name, elapsed in self.calls if name.startswith('datastore_v3')]
+        print '\n    {0} datastore calls, {1} total'.format(len(datastore), len(self.calls)),
+
+
+class BenchLogin(BaseBenchCase):
+
+    def setUp(self):
+        super(BenchLogin, self).setUp()
+        from app import app
+        self.app = TestApp(app)
+
+    def post(self, url, data):
+        # get the form first for the CSRF and session cookie so those calls aren't part of the trace
+        response = self.app.get(url)
+        if 'Set-Cookie' in response.headers:
+            os.environ['HTTP_COOKIE'] = " ".join(response.headers.getall('Set-Cookie'))
+        data['csrf'] = response.body.split('name="csrf" value="', 1)[1].split('"', 1)[0]
+        with RPCTrace() as trace:
+            self.app.post(url, data, headers=HEADERS, extra_environ=ENVIRON)
+        trace.report()
+
+    def test_signup(self):
+        data = {
+            'first_name': ('Test first name' + UCHAR).encode('utf8'),
+            'last_name': ('Test last name' + UCHAR).encode('utf8'),
+            'email': ('signup.test' + UCHAR + '@example.com').encode('utf8'),
+            'password': ('Test password' + UCHAR).encode('utf8')
+        }
+        self.post('/user/signup', data)
+
+    def test_login(self):
+        user = self.createUser()
+        data = {'email': user.email.encode('utf8'), 'password': user.password.encode('utf8')}
+
+        # the first login creates the auth for this device, the second finds it
+        self.post('/user/login', dict(data))
+        self.app.reset()
+        os.environ.pop('HTTP_COOKIE', None)
+        self.post('/user/login', dict(data))
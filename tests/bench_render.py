@@ -0,0 +1,51 @@
+import time
+
+import jinja2
+
+from base import BaseBenchCase
+
+# a stand in for a large admin table
+TEMPLATE = """<html><head><title>Bench</title></head><body><table>
+{% for row in rows %}<tr><td>{{row.0}}</td><td>{{row.1|e}}</td><td>{{row.2}}</td></tr>{% endfor %}
+</table></body></html>"""
+ROWS = [(i, 'user' + str(i) + '@example.com', i * 1.5) for i in xrange(10000)]
+
+
+class BenchRender(BaseBenchCase):
+
+    ROUNDS = 20
+
+    def setUp(self):
+        super(BenchRender, self).setUp()
+        self.template = jinja2.Template(TEMPLATE)
+
+    def firstByte(self, function):
+        # returns the average number of seconds until the first chunk is ready, and until the whole page is
+        first_total = 0
+        last_total = 0
+        for i in xrange(self.ROUNDS):
+            start = time.time()
+            chunks = function()
+            next(chunks)
+            first_total += time.time() - start
+            for chunk in chunks:
+                pass
+            last_total += time.time() - start
+        return first_total / self.ROUNDS, last_total / self.ROUNDS
+
+    def test_firstByte(self):
+        def buffered():
+            return iter([self.template.render(rows=ROWS).encode('utf-8')])
+
+        def streamed():
+            stream = self.template.stream(rows=ROWS).enable_buffering()
+            return (chunk.encode('utf-8') for chunk in stream)
+
+        buffered_first, buffered_last = self.firstByte(buffered)
+        streamed_first, streamed_last = self.firstByte(streamed)
+
+        self.report('buffered first byte', buffered_first)
+        self.report('buffered last byte', buffered_last)
+        self.report('streamed first byte', streamed_first)
+        self.report('streamed last byte', streamed_last)
+        assert streamed_first < buffered_first
@@ -0,0 +1,36 @@
+import webapp2
+
+from base import BaseBenchCase
+
+ROUTE_COUNT = 300
+
+
+class BenchRouter(BaseBenchCase):
+
+    def setUp(self):
+        super(BenchRouter, self).setUp()
+        import router
+
+        # a mix of static and parameterized routes like a large app has, ending in a catch-all
+        routes = []
+        for i in xrange(ROUTE_COUNT / 2):
+            routes.append(('/section' + str(i) + '/page', 'static'))
+            routes.append((r'/section' + str(i) + r'/item/(\d+)', 'param'))
+        routes.append(('/(.*)', 'error'))
+
+        self.routers = [('linear', webapp2.Router(routes)), ('indexed', router.Router(routes))]
+
+    def test_match(self):
+        last = str(ROUTE_COUNT / 2 - 1)
+        paths = [('first static', '/section0/page'), ('last static', '/section' + last + '/page'),
+            ('last param', '/section' + last + '/item/123'), ('not found', '/missing/page')]
+
+        for path_name, path in paths:
+            request = webapp2.Request.blank(path)
+            results = []
+            for router_name, router in self.routers:
+                results.append(router.match(request)[0].handler)
+                self.report(router_name + ' ' + path_name, self.timeit(lambda: router.match(request)))
+
+            # both have to agree on which route it is
+            assert results[0] == results[1]
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import zlib
 from datetime import timedelta
 
 import jinja2
@@ -165,6 +166,62 @@ class TestBase(BaseMockController):
         result = self.controller.compileTemplate(template)
         assert "test compile template" + UCHAR in result
 
+    def test_streamTemplate(self):
+        self.mockSessions()
+        template = jinja2.Template("test stream template" + UCHAR)
+        result = self.controller.streamTemplate(template)
+        assert "".join(result).decode("utf-8") == "test stream template" + UCHAR
+
+    def test_renderStream(self):
+        self.mockSessions()
+        self.controller.renderStream(iter(["test ", "render stream"]))
+        assert "Content-Security-Policy" in self.controller.response.headers
+        assert self.controller.response.body == "test render stream"
+
+        # an error before anything is sent is raised right away so it gets a regular error page
+        def failFirst():
+            raise ValueError("test stream error")
+            yield "never sent"
+        self.assertRaises(ValueError, self.controller.renderStream, failFirst())
+
+        # an error partway through ends the response and is reported
+        def failLater():
+            yield "test "
+            raise ValueError("test stream error")
+        self.controller.initialize(self.getMockRequest(), self.app.app.response_class())
+        self.controller.renderStream(failLater())
+        assert self.controller.response.body == "test "
+        assert len(self.task_stub.GetTasks('mail')) == 1
+
+    def test_securityHeaders(self):
+        headers, split_csp = self.controller.securityHeaders()
+        assert len(split_csp) == 1
+        assert "default-src 'self'" in split_csp[0]
+        assert split_csp[0].endswith("report-uri ")
+        assert 'Content-Security-Policy' not in dict(headers)
+
+        # compiled once per controller, whatever the host
+        assert self.controller.securityHeaders()[0] is headers
+
+        self.controller.setHeaders()
+        csp = self.controller.response.headers['Content-Security-Policy']
+        assert csp.endswith("report-uri http://localhost/policyviolation")
+
+        class NonceController(self.controller_base.BaseController):
+            CSP_NONCE = True
+            HSTS = 'max-age=86400'
+
+        headers, split_csp = NonceController.securityHeaders()
+        assert NonceController.securityHeaders()[0] is not self.controller.securityHeaders()[0]
+        assert dict(headers)['Strict-Transport-Security'] == 'max-age=86400'
+        assert split_csp[0].endswith("script-src 'self' 'nonce-")
+
+        controller = NonceController()
+        controller.initialize(self.getMockRequest(), self.app.app.response_class())
+        controller.setHeaders()
+        nonce = controller.csp_nonce
+        assert "'nonce-" + nonce + "'" in controller.response.headers['Content-Security-Policy']
+
     def test_renderTemplate(self):
         self.mockSessions()
         template = jinja2.Template("test render template" + UCHAR)
@@ -178,6 +235,12 @@ class TestBase(BaseMockController):
         assert self.controller.response.headers['Content-Type'] == "text/html; charset=utf-8"
         assert not self.controller.response.unicode_body
 
+        # streaming gives the same result
+        self.controller.initialize(self.getMockRequest(), self.app.app.response_class())
+        self.controller.STREAM = True
+        self.controller.renderTemplate(template)
+        assert "test render template" + UCHAR in self.controller.response.unicode_body
+
     def test_renderError(self):
         self.mockSessions()
         self.controller.renderError(500)
@@ -280,6 +343,15 @@ class TestBase(BaseMockController):
         assert self.controller.user is not None
         assert self.controller.user.key == user.key
 
+        # a session from before auths were migrated moves over to the new key for the same user agent
+        old_key = self.model.ndb.Key(self.model.Auth, 123, parent=user.key).urlsafe()
+        self.controller.session["auth_key"] = old_key
+        self.controller.request.headers = {"User-Agent": self.auth.user_agent}
+        self.controller.user = self.controller_base.BaseController.user.func(self.controller)
+
+        assert self.controller.user.key == user.key
+        assert self.controller.session["auth_key"] == self.auth.key.urlsafe()
+
     def test_deferEmail(self):
         to = 'test' + UCHAR + '@example.com'
         subject = 'Subject' + UCHAR
@@ -319,31 +391,61 @@ class TestBase(BaseMockController):
 
 class TestForm(BaseMockController):
 
-    class UnicodeMockRequest(object):
+    class MockRequest(object):
         method = "POST"
         host_url = "http://localhost"
 
         def __init__(self, d):
             self.d = d
 
-        def get(self, field):
-            return unicode(self.d.get(field))
+        @property
+        def params(self):
+            return self.d
+
+    class UnicodeMockRequest(MockRequest):
+
+        @property
+        def params(self):
+            return dict([(key, unicode(value)) for key, value in self.d.items()])
 
     def setUp(self):
         super(TestForm, self).setUp()
 
         self.controller = self.controller_base.FormController()
         self.controller.initialize(self.getMockRequest(), self.app.app.response_class())
+        # plans are compiled once per class, so swapping out the fields means clearing them
+        self.addCleanup(self.controller_base.FORM_PLANS.clear)
+
+    def setFields(self, fields):
+        self.controller.FIELDS = fields
+        self.controller_base.FORM_PLANS.clear()
 
     def test_validate(self):
-        self.controller.request = {"valid_field": "value" + UCHAR, "invalid_field": "value" + UCHAR}
-        self.controller.FIELDS = {"valid_field": lambda x: (True, x + "valid"), "invalid_field": lambda x: (False, "")}
+        data = {"valid_field": "value" + UCHAR, "invalid_field": "value" + UCHAR}
+        self.controller.request = self.MockRequest(data)
+        self.setFields({"valid_field": lambda x: (True, x + "valid"), "invalid_field": lambda x: (False, "")})
         form_data, errors, valid_data = self.controller.validate()
 
-        assert form_data == self.controller.request
+        assert form_data == data
         assert errors == {"invalid_field": True}
         assert valid_data == {"valid_field": "value" + UCHAR + "valid"}
 
+        # fields can normalize their values, hide sensitive ones, and say what was wrong
+        Field = self.controller_base.Field
+        data = {"email": "TEST" + UCHAR, "password": "secret", "invalid_field": "value"}
+        self.controller.request = self.MockRequest(data)
+        self.setFields({
+            "email": Field(lambda x: (True, x), normalize=lambda x: x.lower()),
+            "password": Field(lambda x: (True, x), sensitive=True),
+            "invalid_field": Field(lambda x: (False, x)),
+            "missing_field": Field(lambda x: (False, x))
+        })
+        form_data, errors, valid_data = self.controller.validate()
+
+        assert form_data == {"email": "TEST" + UCHAR, "invalid_field": "value", "missing_field": ""}
+        assert errors == {"invalid_field": "invalid", "missing_field": "required"}
+        assert valid_data == {"email": "test" + UCHAR, "password": "secret"}
+
         # non-utf8 should result in a bad request
         self.mockSessions()
         self.controller.request = self.UnicodeMockRequest({"valid_field": "\xff"})
@@ -464,7 +566,32 @@ class TestError(BaseTestController):
 
     def test_error(self):
         # this just covers any URL not handled by something else - always produces 404
-        assert self.app.get('/nothing-to-see-here', status=404)
+        response = self.app.get('/nothing-to-see-here', status=404)
+        assert 'Error 404: Not Found' in response
+
+        # without a session there's no need to start one
+        assert 'Set-Cookie' not in response.headers
+
+        # signed in users get the regular page
+        self.createUser()
+        self.login()
+        response = self.app.get('/nothing-to-see-here', status=404)
+        assert 'Error 404: Not Found' in response
+        assert 'Account Settings' in response
+
+    def test_missingPaths(self):
+        orig_rate = self.model.MISSING_SAMPLE_RATE
+        self.model.MISSING_SAMPLE_RATE = 1
+        try:
+            self.app.get('/wp-admin', status=404)
+            self.app.get('/wp-admin', status=404)
+            self.app.head('/wp-login.php', status=404)
+        finally:
+            self.model.MISSING_SAMPLE_RATE = orig_rate
+
+        missing_paths = self.model.getMissingPaths()
+        assert missing_paths[0][0] == '/wp-admin'
+        assert missing_paths[1][0] == '/wp-login.php'
 
     def test_logError(self):
         # static error pages call this to log to try to log themselves
@@ -533,8 +660,81 @@ class TestHome(BaseTestController):
 class TestSitemap(BaseTestController):
 
     def test_sitemap(self):
+        # the first request starts building the shards in the background
         response = self.app.get('/sitemap.xml')
+        assert '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">' in response
+        assert '/sitemaps/0.xml' not in response
+
+        self.executeDeferred()
+
+        response = self.app.get('/sitemap.xml')
+        assert '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">' in response
+        assert '/sitemaps/0.xml' in response
+
+        response = self.app.get('/sitemaps/0.xml')
         assert '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">' in response
+        assert '/user/signup</loc>' in response
+
+        assert self.app.get('/sitemaps/1.xml', status=404)
+
+        # a request on another host doesn't start the build over
+        self.app.get('/sitemap.xml', extra_environ={'HTTP_HOST': 'other.example.org'})
+        assert not self.task_stub.GetTasks('default')
+
+        # once it's cached the index is served without reading the state
+        # the lock left by finishing the build is cleared so that it can be
+        self.model.memcache.flush_all()
+        self.app.get('/sitemap.xml')
+        state = self.model.Sitemap.getState()
+        state.key.delete()
+        assert '/sitemaps/0.xml' in self.app.get('/sitemap.xml')
+
+        # a shard that's gone from GCS is missing rather than an error
+        state.put()
+        from controllers import sitemap
+        import cloudstorage as gcs
+        gcs.delete(sitemap.shardPath(state.generation, 0))
+        assert self.app.get('/sitemaps/0.xml', status=404)
+
+    def test_sitemapBaseURL(self):
+        from controllers import sitemap
+
+        # the configured URL is used no matter what host the request came in on
+        orig_base_url = sitemap.BASE_URL
+        sitemap.BASE_URL = 'https://www.example.com'
+        try:
+            self.app.get('/sitemap.xml', extra_environ={'HTTP_HOST': 'attacker.example.org'})
+            self.executeDeferred()
+        finally:
+            sitemap.BASE_URL = orig_base_url
+
+        response = self.app.get('/sitemaps/0.xml')
+        assert '<loc>https://www.example.com/user/signup</loc>' in response
+        assert 'attacker' not in response
+
+    def test_sitemapShards(self):
+        from controllers import sitemap
+
+        # a source big enough to need more than one shard
+        def source(cursor, limit):
+            start = int(cursor or 0)
+            end = min(start + limit, sitemap.SHARD_SIZE + 1)
+            entries = [('/page/' + str(i), 0.5) for i in xrange(start, end)]
+            return entries, end <= sitemap.SHARD_SIZE and str(end) or None
+
+        sitemap.registerSource('test', source)
+        try:
+            self.app.get('/sitemap.xml')
+            self.executeDeferred()
+        finally:
+            del sitemap.SOURCES['test']
+
+        response = self.app.get('/sitemap.xml')
+        assert '/sitemaps/1.xml' in response
+        assert '/sitemaps/2.xml' not in response
+
+        response = self.app.get('/sitemaps/1.xml')
+        assert '/page/' + str(sitemap.SHARD_SIZE) + '</loc>' in response
 
 
 class TestStatic(BaseTestController):
@@ -568,10 +768,24 @@ class TestUser(BaseTestController):
         response = response.follow()
         assert '<h2>Account Settings</h2>' in response
 
-        # test delete
+        # test that a picture being processed can be polled for
+        self.user.pic_blob = self.model.ndb.BlobKey('test blob')
+        self.user.pic_status = self.model.User.PIC_PROCESSING
+        self.user.put()
+        self.model.uncache(self.user.slug, namespace=self.model.CACHE_USERS)
+        response = self.app.get('/user')
+        assert 'id="pic-processing"' in response
+
+        # test delete - the files are removed by a task
         response = self.sessionPost('/user', {'delete': '1'})
         response = response.follow()
         assert '<h2>Account Settings</h2>' in response
+        assert 'id="pic-processing"' not in response
+        assert len(self.task_stub.GetTasks('images')) == 1
+
+        user = self.user.key.get()
+        assert user.pic_blob is None
+        assert user.pic_status is None
 
     def test_auths(self):
         self.login()
@@ -584,6 +798,14 @@ class TestUser(BaseTestController):
         assert user_auth.key.urlsafe() not in response
         assert 'Current Session' in response
 
+        # an auth whose user agent couldn't be parsed shows it as is
+        unparsed_auth = self.createAuth(self.user, user_agent='unparsed user agent' + UCHAR)
+        unparsed_auth.os = unparsed_auth.browser = unparsed_auth.device = ''
+        unparsed_auth.put()
+        response = self.app.get('/user/auths')
+        assert 'unparsed user agent' in response
+        assert 'test browser' in response
+
         data = {'auth_key': 'invalid'}
 
         response = self.sessionPost('/user/auths', data)
@@ -602,6 +824,42 @@ class TestUser(BaseTestController):
         assert 'Access revoked.' in response
         assert '<h2>Log In</h2>' in response
 
+    def test_authsOthers(self):
+        self.login()
+        self.createAuth(self.user)
+        self.createAuth(self.user)
+
+        response = self.sessionPost('/user/auths', {'others': '1'})
+        response = response.follow()
+        assert 'Access revoked for all other sessions.' in response
+
+        # only the current session is left, and we're still logged in
+        assert len(list(self.user.auths)) == 1
+        assert 'Current Session' in response
+
+    def test_authsPages(self):
+        self.login()
+        self.createAuth(self.user)
+
+        from controllers import user as user_controllers
+        orig_page_size = user_controllers.AuthsController.PAGE_SIZE
+        user_controllers.AuthsController.PAGE_SIZE = 1
+        try:
+            response = self.app.get('/user/auths')
+            assert 'First Page' not in response
+            assert 'Next Page' in response
+
+            cursor = response.body.split('/user/auths?cursor=', 1)[1].split('"', 1)[0]
+            response = self.app.get('/user/auths?cursor=' + cursor)
+            assert '<h2>Active Sessions</h2>' in response
+            assert 'First Page' in response
+
+            # an invalid cursor starts over
+            response = self.app.get('/user/auths?cursor=invalid')
+            assert 'First Page' not in response
+        finally:
+            user_controllers.AuthsController.PAGE_SIZE = orig_page_size
+
     def test_changeEmail(self):
         self.login()
 
@@ -659,20 +917,26 @@ class TestUser(BaseTestController):
         response = response.follow()
         assert 'That email address is already in use.' in response
 
-        # signup succeeds but won't login without valid user agent or IP address
+        # signup fails without a valid user agent or IP address, and no user is left behind
         data["email"] = ("signup.test" + UCHAR + "@example.com").encode("utf8")
 
         response = self.sessionPost('/user/signup', data)
         response = response.follow()
         assert 'Invalid client.' in response
+        assert 'Thank you for signing up!' not in response
+        assert not self.model.User.getByEmail(data["email"].decode("utf8").lower())
 
-        # success - use a new email address to avoid conflict with the previous partial success
-        data["email"] = ("signup2.test" + UCHAR + "@example.com").encode("utf8")
+        # success - the same email address can be used since nothing was saved
 
         response = self.sessionPost('/user/signup', data, headers=HEADERS, extra_environ=ENVIRON)
         response = response.follow()
         assert '<h2>Logged In Home Page</h2>' in response
 
+        # the new user and their session are counted in the stats
+        stats = self.model.sumStats()
+        assert stats['users'] == 1
+        assert stats['auths'] == 1
+
     def test_login(self):
         response = self.app.get('/user/login')
         assert '<h2>Log In</h2>' in response
@@ -705,6 +969,25 @@ class TestUser(BaseTestController):
         response = response.follow() # redirects to home page
         assert '<h2>Logged In Home Page</h2>' in response
 
+    def test_loginRateLimit(self):
+        import ratelimit
+        # whatever was blocked before is put back afterwards, even when the test fails
+        orig_blocked = ratelimit._blocked.copy()
+        self.addCleanup(ratelimit._blocked.update, orig_blocked)
+        self.addCleanup(ratelimit._blocked.clear)
+        ratelimit._blocked.clear()
+
+        self.sessionGet('/user/login')
+        data = {"email": self.user.email.encode("utf8"), "password": "wrong password"}
+        for i in xrange(10):
+            response = self.sessionPost('/user/login', data, headers=HEADERS, extra_environ=ENVIRON)
+            assert response.status_int == 302
+
+        # too many attempts for the same account, even when they're typed differently
+        data["email"] = self.user.email.upper().encode("utf8")
+        response = self.sessionPost('/user/login', data, headers=HEADERS, extra_environ=ENVIRON, status=429)
+        assert int(response.headers['Retry-After']) > 0
+
     def test_logout(self):
         self.login()
 
@@ -715,6 +998,14 @@ class TestUser(BaseTestController):
         response = response.follow() # redirects to index page
         assert '<h2>Index Page</h2>' in response
 
+        # logging out everywhere revokes every session
+        self.login()
+        self.createAuth(self.user)
+        response = self.app.post('/user/logout', {'csrf': self.getCsrf('/home'), 'everywhere': '1'})
+        response = response.follow()
+        assert '<h2>Index Page</h2>' in response
+        assert not list(self.user.auths)
+
     def test_forgotPassword(self):
         response = self.app.get('/user/forgotpassword')
         assert '<h2>Forget Your Password?</h2>' in response
@@ -781,6 +1072,8 @@ class TestUser(BaseTestController):
         self.sessionGet('/user/resetpassword?key=' + key + '&token=' + self.user.token)
 
         response = self.sessionPost('/user/resetpassword', data, headers=HEADERS, extra_environ=ENVIRON)
+        # the reset token isn't mistaken for an API token, so the session with the login is saved
+        assert 'Set-Cookie' in response.headers
         response = response.follow()
         assert '<h2>Logged In Home Page</h2>' in response
 
@@ -816,6 +1109,8 @@ class TestAdmin(BaseTestController):
 
     def setUp(self):
         super(TestAdmin, self).setUp()
+        from controllers import admin
+        self.admin = admin
         self.normal_user = self.createUser()
         self.admin_user = self.createUser(email="admin.test@example.com", is_admin=True)
 
@@ -829,6 +1124,167 @@ class TestAdmin(BaseTestController):
 
         response = self.app.get('/admin')
         assert '<h2>Admin</h2>' in response
+        assert '<h3>Missing Pages</h3>' in response
+
+    def test_stats(self):
+        self.model.updateStats({'users': 1234, 'browser:Test Browser': 2})
+        self.login(self.admin_user)
+
+        response = self.app.get('/admin')
+        assert '<h3>Stats</h3>' in response
+        assert 'Users: 1,234' in response
+        assert 'Test Browser' in response
+
+    def test_users(self):
+        self.login(self.normal_user)
+        assert self.app.get('/admin/users', status=403)
+
+        self.logout()
+        self.login(self.admin_user)
+
+        response = self.app.get('/admin/users')
+        assert '<h2>Users</h2>' in response
+        assert 'No users found.' not in response
+
+        response = self.app.get('/admin/users?q=admin')
+        assert 'admin.test@example.com' in response
+        assert self.normal_user.email not in response
+
+        response = self.app.get('/admin/users?q=nobody')
+        assert 'No users found.' in response
+
+        response = self.app.get('/admin/users?start=invalid')
+        assert 'Please enter a valid date.' in response
+
+        # searches are shown back escaped
+        response = self.app.get('/admin/users?q="><b>test')
+        assert '"><b>test' not in response
+        assert '&#34;&gt;&lt;b&gt;test' in response
+
+        # paging keeps the search
+        orig_size = self.admin.UsersController.PAGE_SIZE
+        self.admin.UsersController.PAGE_SIZE = 1
+        try:
+            response = self.app.get('/admin/users?q=example&start=2000-01-01')
+            assert 'admin.test@example.com' in response
+            response = response.click('Next Page')
+            assert self.normal_user.email in response
+            assert '/admin/users?q=example&amp;start=2000-01-01' in response
+        finally:
+            self.admin.UsersController.PAGE_SIZE = orig_size
+
+    def test_export(self):
+        # spreadsheet formulas aren't run when the file is opened
+        self.normal_user.first_name = u"=1+2" + UCHAR
+        self.normal_user.put()
+        self.login(self.admin_user)
+
+        self.sessionGet('/admin')
+        response = self.sessionPost('/admin/export', {'kind': 'Invalid', 'format': 'csv'})
+        response = response.follow()
+        assert 'Please choose what to export.' in response
+
+        response = self.sessionPost('/admin/export', {'kind': 'User', 'format': 'csv'})
+        response = response.follow()
+        assert 'Export started.' in response
+
+        export = self.model.Export.query().get()
+        assert export.status == self.model.Export.STARTED
+        # not ready to download yet
+        assert self.app.get('/admin/exports/' + str(export.key.id()), status=404)
+
+        self.executeDeferred()
+        export = export.key.get()
+        assert export.status == self.model.Export.FINISHED
+        assert export.count == 2
+        assert len(self.task_stub.GetTasks('mail')) == 1
+
+        response = self.app.get('/admin/exports/' + str(export.key.id()))
+        assert response.headers['Content-Type'] == 'text/csv'
+        lines = response.body.splitlines()
+        assert len(lines) == 3
+        assert lines[0].startswith('key,created_date,email')
+        assert self.normal_user.email.encode('utf-8') in response.body
+        assert 'hashed_password' not in response.body
+        assert self.normal_user.hashed_password not in response.body
+        assert ",'=1+2" in response.body
+        assert ",=1+2" not in response.body
+
+        # a file that's gone from GCS isn't sent as an empty download
+        import cloudstorage as gcs
+        gcs.delete(export.gcs_path)
+        assert self.app.get('/admin/exports/' + str(export.key.id()), status=404)
+
+    def test_exportJSONLines(self):
+        self.createAuth(self.normal_user)
+        self.login(self.admin_user)
+
+        self.sessionGet('/admin')
+        self.sessionPost('/admin/export', {'kind': 'Auth', 'format': 'jsonl'})
+
+        # a small batch makes it take more than one task
+        from controllers import job
+        orig_batch = job.ExportController.BATCH
+        orig_seconds = job.ExportController.MAX_SECONDS
+        job.ExportController.BATCH = 1
+        job.ExportController.MAX_SECONDS = 0
+        try:
+            self.executeDeferred()
+        finally:
+            job.ExportController.BATCH = orig_batch
+            job.ExportController.MAX_SECONDS = orig_seconds
+
+        export = self.model.Export.query().get()
+        assert export.status == self.model.Export.FINISHED
+        assert export.step > 0
+
+        response = self.app.get('/admin/exports/' + str(export.key.id()))
+        rows = [json.loads(line) for line in response.body.splitlines()]
+        assert len(rows) == 2
+        assert 'browser' in rows[0]
+        assert 'token_hash' not in rows[0]
+
+    def test_revoke(self):
+        self.createAuth(self.normal_user)
+        self.login(self.admin_user)
+
+        self.sessionGet('/admin')
+        response = self.sessionPost('/admin', {'revoke': '1', 'email': 'doesnt.exist@example.com'})
+        response = response.follow()
+        assert 'There is no user associated with that email address.' in response
+
+        response = self.sessionPost('/admin', {'revoke': '1', 'email': self.normal_user.email.encode('utf8')})
+        response = response.follow()
+        assert "Access revoked for all of that user's sessions." in response
+        assert not list(self.normal_user.auths)
+
+
+class TestAPIController(BaseMockController):
+
+    def setUp(self):
+        super(TestAPIController, self).setUp()
+        from controllers import api
+        self.controller = api.APIController()
+        self.controller.initialize(self.getMockRequest(), self.app.app.response_class())
+
+    def test_renderList(self):
+        self.mockSessions()
+        self.controller.renderList(iter([{"name": "first"}, {"name": "second"}]), {"cursor": "next"})
+        data = json.loads(self.controller.response.body)
+        assert len(data["items"]) == 2
+        assert data["cursor"] == "next"
+
+        # an error partway through still ends with valid JSON, and is reported
+        def failLater():
+            yield {"name": "first"}
+            raise ValueError("test list error")
+        self.controller.initialize(self.getMockRequest(), self.app.app.response_class())
+        self.controller.renderList(failLater(), {"cursor": "next"})
+        data = json.loads(self.controller.response.body)
+        assert data["items"] == [{"name": "first"}]
+        assert data["error"] == "incomplete"
+        assert "cursor" not in data
+        assert len(self.task_stub.GetTasks("mail")) == 1
 
 
 class TestAPI(BaseTestController):
@@ -845,6 +1301,138 @@ class TestAPI(BaseTestController):
         response = self.sessionPost('/api/upload', {'url': '/user'})
         assert 'url' in response
 
+    def test_uploadSessions(self):
+        self.sessionGet('/user')
+
+        response = self.sessionPost('/api/uploads', {'filename': 'profile.txt', 'size': '100'}, status=400)
+        assert json.loads(response.body)['error'] == 'type'
+
+        response = self.sessionPost('/api/uploads', {'filename': 'profile.jpg', 'size': '0'}, status=400)
+        assert json.loads(response.body)['error'] == 'size'
+
+        response = self.sessionPost('/api/uploads', {'filename': 'profile.jpg', 'size': '100'})
+        data = json.loads(response.body)
+        assert data['url']
+        assert data['size'] == 100
+
+        upload = self.model.Upload.get_by_id(data['id'], parent=self.user.key)
+        assert upload.status == self.model.Upload.STARTED
+
+    def test_uploadSession(self):
+        self.sessionGet('/user')
+
+        response = self.sessionPost('/api/uploads', {'filename': 'profile.jpg', 'size': '100'})
+        upload_id = str(json.loads(response.body)['id'])
+
+        response = self.app.get('/api/uploads/' + upload_id)
+        data = json.loads(response.body)
+        assert data['status'] == self.model.Upload.STARTED
+        assert data['received'] == 0
+
+        # nothing has been sent yet, so it can't be finished
+        response = self.sessionPost('/api/uploads/' + upload_id, {}, status=409)
+        assert json.loads(response.body)['error'] == 'incomplete'
+
+        # pretend the client sent the whole file
+        import cloudstorage as gcs
+        upload = self.model.Upload.get_by_id(int(upload_id), parent=self.user.key)
+        with gcs.open(upload.gcs_path, 'w') as f:
+            f.write('file content')
+
+        response = self.sessionPost('/api/uploads/' + upload_id, {})
+        data = json.loads(response.body)
+        assert data['status'] == self.model.Upload.FINISHED
+        assert data['pic_status'] == self.model.User.PIC_PROCESSING
+        assert len(self.task_stub.GetTasks('images')) == 1
+
+        # other users' uploads can't be found
+        assert self.app.get('/api/uploads/1' + upload_id, status=404)
+
+    def test_pic(self):
+        response = self.app.get('/api/pic')
+        data = json.loads(response.body)
+        assert data == {'status': None, 'url': None, 'thumbs': {}}
+
+    def test_user(self):
+        response = self.app.get('/api/user')
+        assert response.headers['Content-Type'] == 'application/json; charset=utf-8'
+        data = json.loads(response.body)['user']
+        assert data['key'] == self.user.key.urlsafe()
+        assert data['email'] == self.user.email
+        assert data['created_date'] == self.user.created_date.isoformat()
+        # only the listed fields are ever sent
+        assert 'hashed_password' not in data
+        assert 'password_salt' not in data
+
+        # small responses aren't compressed
+        response = self.app.get('/api/user', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+        self.logout()
+        response = self.app.get('/api/user', status=401)
+        assert json.loads(response.body)['error'] == 'unauthorized'
+
+    def test_auths(self):
+        self.createAuth(self.user, 'Another UA')
+
+        response = self.app.get('/api/auths?limit=1')
+        data = json.loads(response.body)
+        assert len(data['items']) == 1
+        assert data['cursor']
+
+        response = self.app.get('/api/auths?limit=1&cursor=' + data['cursor'])
+        data = json.loads(response.body)
+        assert len(data['items']) == 1
+
+        response = self.app.get('/api/auths')
+        data = json.loads(response.body)
+        assert len(data['items']) == 2
+        assert data['cursor'] is None
+
+        # lists are always compressed when the client allows it
+        response = self.app.get('/api/auths', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        body = zlib.decompress(response.body, 16 + zlib.MAX_WBITS)
+        assert len(json.loads(body)['items']) == 2
+
+        assert self.app.get('/api/auths?cursor=invalid', status=400)
+
+    def test_token(self):
+        self.model._tokens.clear()
+
+        response = self.app.post('/api/token', {'email': self.user.email.encode('utf8'), 'password': 'wrong'},
+            headers=HEADERS, extra_environ=ENVIRON, status=401)
+        assert json.loads(response.body)['error'] == 'match'
+
+        response = self.app.post('/api/token', {'email': 'invalid'}, headers=HEADERS, extra_environ=ENVIRON,
+            status=400)
+        assert json.loads(response.body)['error'] == 'invalid'
+
+        response = self.app.post('/api/token', {'email': self.user.email.encode('utf8'),
+            'password': self.user.password.encode('utf8')}, headers=HEADERS, extra_environ=ENVIRON)
+        token = json.loads(response.body)['token']
+
+        # the token works without a session cookie, and doesn't start one
+        self.logout()
+        os.environ.pop('HTTP_COOKIE', None)
+        headers = {'Authorization': 'Bearer ' + str(token)}
+        response = self.app.get('/api/user', headers=headers)
+        assert json.loads(response.body)['user']['email'] == self.user.email
+        assert 'Set-Cookie' not in response.headers
+
+        # nor does it need a CSRF
+        response = self.app.post('/api/uploads', {'filename': 'profile.jpg', 'size': '100'}, headers=headers)
+        assert json.loads(response.body)['url']
+
+        response = self.app.get('/api/user', headers={'Authorization': 'Bearer invalid'}, status=401)
+        assert json.loads(response.body)['error'] == 'unauthorized'
+
+        # revoking the auth revokes its token
+        self.model._tokens.clear()
+        self.model.ndb.Key(urlsafe=str(token).split('.')[0]).delete()
+        self.model.uncache(str(token).split('.')[0], namespace=self.model.CACHE_USERS)
+        assert self.app.get('/api/user', headers=headers, status=401)
+
 
 class TestDev(BaseTestController):
 
@@ -856,13 +1444,110 @@ class TestDev(BaseTestController):
         response = self.sessionPost('/dev', {"memcache": "1"})
         assert response.status_int == 302
 
+        # test invalidating a single cache namespace
+        response = self.sessionPost('/dev', {"invalidate": "pages"})
+        response = response.follow()
+        assert 'Invalidated Pages Cache' in response
+
 
 class TestJob(BaseTestController):
 
+    def test_activity(self):
+        response = self.app.get('/job/activity')
+        assert 'OK' in response
+
     def test_auths(self):
-        response = self.app.get('/job/auths')
+        user = self.createUser()
+        recent_auth = self.createAuth(user)
+        old_auths = [self.createAuth(user) for i in range(3)]
+        for auth in old_auths:
+            auth.last_login -= timedelta(days=30)
+            auth.put()
+
+        # a small batch makes it take more than one
+        orig_batch = self.model.REVOKE_BATCH
+        self.model.REVOKE_BATCH = 2
+        try:
+            response = self.app.get('/job/auths')
+        finally:
+            self.model.REVOKE_BATCH = orig_batch
         assert 'OK' in response
 
+        assert self.model.Auth.query(ancestor=user.key).fetch(keys_only=True) == [recent_auth.key]
+        assert self.model.sumStats()['auths'] == -3
+
+    def test_stats(self):
+        user = self.createUser()
+        self.createAuth(user)
+        self.model.updateStats({'users': 5})
+
+        response = self.app.get('/job/stats')
+        assert 'OK' in response
+        self.executeDeferred()
+
+        stats = self.model.getStats()
+        assert stats['users'] == 1
+        assert stats['auths'] == 1
+
+    def test_image(self):
+        blob_key = self.model.ndb.BlobKey('missing blob')
+        user = self.createUser(pic_blob=blob_key, pic_status=self.model.User.PIC_PROCESSING)
+
+        # a blob that can't be served as an image is marked invalid
+        response = self.app.post('/job/image', {'user_key': user.slug, 'blob': str(blob_key)})
+        assert 'OK' in response
+
+        user = user.key.get()
+        assert user.pic_status == self.model.User.PIC_INVALID
+        assert user.pic_blob is None
+
+    def test_imageDelete(self):
+        response = self.app.post('/job/image/delete', {'blob': 'missing blob'})
+        assert 'OK' in response
+
+        import cloudstorage as gcs
+        with gcs.open('/bucket/pic.jpg', 'w') as f:
+            f.write('test')
+
+        # files already deleted by an earlier attempt are skipped
+        response = self.app.post('/job/image/delete', {'gcs': ['/gs/bucket/pic.jpg', '/gs/bucket/missing.jpg']})
+        assert 'OK' in response
+        self.assertRaises(gcs.NotFoundError, gcs.stat, '/bucket/pic.jpg')
+
+    def test_sitemap(self):
+        # nothing happens until the base URL is known
+        response = self.app.get('/job/sitemap')
+        assert 'OK' in response
+        assert not self.task_stub.GetTasks('default')
+
+        state = self.model.Sitemap.getState()
+        state.base_url = 'http://localhost'
+        state.put()
+
+        response = self.app.get('/job/sitemap')
+        assert 'OK' in response
+        self.executeDeferred()
+
+        state = self.model.Sitemap.getState()
+        assert state.generation
+        assert state.shards == 1
+        assert state.building is None
+
+    def test_migrateAuths(self):
+        response = self.app.post('/job/migrate/auths', {})
+        assert 'OK' in response
+
+    def test_revoke(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+        self.createAuth(user)
+
+        data = {'user_key': user.key.urlsafe(), 'except_key': auth.key.urlsafe(), 'cursor': ''}
+        response = self.app.post('/job/revoke', data)
+        assert 'OK' in response
+
+        assert [key for key in user.auths.iter(keys_only=True)] == [auth.key]
+
     def test_email(self):
         data = {
             'to': ('test' + UCHAR + '@example.com').encode('utf-8'),
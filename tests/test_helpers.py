@@ -1,3 +1,6 @@
+import struct
+from StringIO import StringIO
+
 from base import BaseTestCase
 
 
@@ -130,3 +133,66 @@ class TestHelpers(BaseTestCase):
 
         result = self.helpers.int_comma(1000000)
         assert result == "1,000,000"
+
+    def test_LRUCache(self):
+        lru = self.helpers.LRUCache(2)
+        lru.set("one", 1)
+        lru.set("two", 2)
+        assert lru.get("one") == 1
+
+        # "two" is now the least recently used, so it's the one dropped
+        lru.set("three", 3)
+        assert lru.get("two") is None
+        assert lru.get("one") == 1
+        assert lru.get("three") == 3
+
+        lru.clear()
+        assert lru.get("one") is None
+
+    def test_parse_user_agent(self):
+        ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        ua += "Chrome/70.0.3538.77 Safari/537.36"
+        result = self.helpers.parse_user_agent(ua)
+        assert result == ("Windows", "Chrome", "")
+
+        # the second time comes from the cache
+        orig_detect = self.helpers.detect_user_agent
+        self.helpers.detect_user_agent = lambda ua: ("", "", "")
+        try:
+            result = self.helpers.parse_user_agent(ua)
+        finally:
+            self.helpers.detect_user_agent = orig_detect
+        assert result == ("Windows", "Chrome", "")
+
+    def test_detect_user_agent(self):
+        ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:63.0) Gecko/20100101 Firefox/63.0"
+        os_name, browser, device = self.helpers.detect_user_agent(ua)
+        assert os_name == "Windows"
+        assert browser == "Firefox"
+        assert device == ""
+
+    def test_gcs_path(self):
+        assert self.helpers.gcs_path("/gs/bucket/object") == "/bucket/object"
+        assert self.helpers.gcs_path("/bucket/object") == "/bucket/object"
+
+    def test_detect_image(self):
+        gif = StringIO("GIF89a" + struct.pack("<HH", 10, 20) + "\x00" * 100)
+        assert self.helpers.detect_image(gif) == ("gif", 10, 20)
+
+        png = StringIO("\x89PNG\r\n\x1a\n" + "\x00\x00\x00\x0dIHDR" + struct.pack(">II", 30, 40) + "\x00" * 100)
+        assert self.helpers.detect_image(png) == ("png", 30, 40)
+
+        # the frame header comes after other segments, which are skipped over without reading them
+        app0 = "\xff\xe0" + struct.pack(">H", 2000) + "\x00" * 1998
+        sof = "\xff\xc0" + struct.pack(">H", 17) + "\x08" + struct.pack(">HH", 60, 50) + "\x00" * 10
+        jpeg = StringIO("\xff\xd8" + app0 + sof + "\xff\xda")
+        assert self.helpers.detect_image(jpeg) == ("jpeg", 50, 60)
+
+        # a scan before any frame header means it's corrupt
+        assert self.helpers.detect_image(StringIO("\xff\xd8" + app0 + "\xff\xda")) is None
+
+        # so is a truncated file or one with no size
+        assert self.helpers.detect_image(StringIO("\xff\xd8" + app0[:100])) is None
+        assert self.helpers.detect_image(StringIO("GIF89a" + struct.pack("<HH", 0, 20))) is None
+
+        assert self.helpers.detect_image(StringIO("not an image")) is None
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from base import BaseTestCase, UCHAR
 
@@ -13,6 +13,36 @@ class TestUser(BaseTestCase):
         queried_user = self.model.User.getByEmail(created_user.email)
         assert created_user.key == queried_user.key
 
+    def test_searchTokens(self):
+        user = self.createUser(email='Jane.Doe@Example.com')
+        assert 'j' in user.search_tokens
+        assert 'jane' in user.search_tokens
+        assert 'doe' in user.search_tokens
+        assert 'example' in user.search_tokens
+        assert 'test' in user.search_tokens
+        assert 'name' + UCHAR in user.search_tokens
+        assert 'janedoe' not in user.search_tokens
+
+        # long words are only indexed up to a point
+        assert self.model.searchTokens('a' * 30) == ['a' * i for i in range(1, self.model.SEARCH_PREFIX_MAX + 1)]
+
+    def test_search(self):
+        user = self.createUser(email='jane.doe@example.com')
+        other_user = self.createUser(email='john.smith@example.com')
+        other_user.created_date = datetime(2000, 1, 1)
+        other_user.put()
+
+        assert self.model.User.search('jan').fetch() == [user]
+        assert self.model.User.search('JANE DO').fetch() == [user]
+        assert self.model.User.search('jane.doe@example.com').fetch() == [user]
+        assert not self.model.User.search('jane smith').fetch()
+
+        # newest first
+        assert self.model.User.search('example').fetch() == [user, other_user]
+
+        assert self.model.User.search(start=datetime(2001, 1, 1)).fetch() == [user]
+        assert self.model.User.search('example', end=datetime(2001, 1, 1)).fetch() == [other_user]
+
     def test_hashPassword(self):
         # stub so we get constant results
         orig_pepper = self.model.PASSWORD_PEPPER
@@ -46,6 +76,20 @@ class TestUser(BaseTestCase):
         hsh += "0a6ef5b80f7c53c20e624d4e9f2279ab2693a0f3278cffd1481b6a1252bbe0dc"
         assert hashed_password == hsh
 
+    def test_getAuth(self):
+        user = self.createUser()
+        auth = self.createAuth(user, user_agent="test user agent" + UCHAR)
+
+        assert user.getAuth("test user agent" + UCHAR).key == auth.key
+        assert user.getAuth("other user agent" + UCHAR) is None
+
+    def test_picThumbnails(self):
+        user = self.createUser()
+        assert user.pic_thumbnails == {}
+
+        user.pic_thumbs = ['url=s' + str(size) for size in self.model.User.PIC_SIZES]
+        assert user.pic_thumbnails[100] == 'url=s100'
+
     def test_resetPassword(self):
         user = self.createUser()
 
@@ -69,6 +113,116 @@ class TestModelFunctions(BaseTestCase):
         gotten_user = self.model.getByKey(created_user.key.urlsafe())
         assert created_user.key == gotten_user.key
 
+    def test_updatePic(self):
+        blob_key = self.model.ndb.BlobKey('test blob')
+        user = self.createUser(pic_blob=blob_key, pic_status=self.model.User.PIC_PROCESSING)
+
+        updated_user = self.model.updatePic(user.key, blob_key, pic_status=self.model.User.PIC_READY)
+        assert updated_user.pic_status == self.model.User.PIC_READY
+        assert user.key.get().pic_status == self.model.User.PIC_READY
+
+        # a picture that's since been replaced is left alone
+        other_key = self.model.ndb.BlobKey('other blob')
+        assert self.model.updatePic(user.key, other_key, pic_status=self.model.User.PIC_INVALID) is None
+        assert user.key.get().pic_status == self.model.User.PIC_READY
+
+    def test_saveExport(self):
+        export = self.model.Export(kind="User", format="csv", gcs_path="/bucket/export.csv",
+            email="test" + UCHAR + "@example.com", host_url="http://localhost")
+        self.model.saveExport(export)
+
+        assert export.key.get()
+        tasks = self.task_stub.GetTasks("default")
+        assert len(tasks) == 1
+        assert tasks[0]["url"] == "/job/export"
+
+    def test_claimExport(self):
+        export = self.model.Export(kind="User", format="csv", gcs_path="/bucket/export.csv",
+            email="test" + UCHAR + "@example.com", host_url="http://localhost")
+        export.put()
+
+        claimed = self.model.claimExport(export.key, 0, 60)
+        assert claimed.leased_until > datetime.utcnow()
+
+        # only one task can have a step at a time, and other steps are already done or not ready yet
+        assert self.model.claimExport(export.key, 0, 60) is None
+        assert self.model.claimExport(export.key, 1, 60) is None
+
+        # a lease that's run out can be taken over
+        claimed.leased_until = datetime.utcnow() - timedelta(seconds=1)
+        claimed.put()
+        assert self.model.claimExport(export.key, 0, 60)
+
+        # saving the next step lets it go
+        claimed.step += 1
+        self.model.saveExport(claimed)
+        assert claimed.key.get().leased_until is None
+        assert self.model.claimExport(export.key, 1, 60)
+
+    def test_migrateAuths(self):
+        user = self.createUser()
+        user_agent = "test user agent" + UCHAR
+
+        # the old way auths were created, there can be more than one with the same user agent
+        old_auths = []
+        for ip in ["127.0.0.2", "127.0.0.3"]:
+            old_auth = self.model.Auth(user_agent=user_agent, os="test os", browser="test browser",
+                device="test device", ip=ip, parent=user.key)
+            old_auth.put()
+            old_auths.append(old_auth)
+
+        # stopping at the limit returns a cursor to continue from
+        cursor = self.model.migrateAuths(limit=1)
+        assert cursor
+        assert self.model.migrateAuths(cursor=cursor) is None
+
+        auths = self.model.Auth.query(ancestor=user.key).fetch()
+        assert len(auths) == 1
+        assert auths[0].key == self.model.Auth.keyFor(user.key, user_agent)
+        assert auths[0].ip == "127.0.0.3"
+
+        # sessions with an old key can still find the new one
+        old_key = old_auths[0].key.urlsafe()
+        assert self.model.migratedAuthKey(old_key, user_agent) == auths[0].key.urlsafe()
+        assert self.model.migratedAuthKey(auths[0].key.urlsafe(), user_agent) is None
+        assert self.model.migratedAuthKey("invalid", user_agent) is None
+
+    def test_migrateUsers(self):
+        # users saved before there were search tokens don't have any
+        orig_hook = self.model.User._pre_put_hook
+        self.model.User._pre_put_hook = lambda user: None
+        try:
+            users = [self.createUser(email='test' + str(i) + '@example.com') for i in range(3)]
+        finally:
+            self.model.User._pre_put_hook = orig_hook
+        assert not self.model.User.search('test1').fetch()
+
+        cursor = self.model.migrateUsers(limit=2)
+        assert cursor
+        assert self.model.migrateUsers(cursor=cursor) is None
+        assert self.model.User.search('test1').fetch() == [users[1]]
+
+    def test_revokeAuths(self):
+        user = self.createUser()
+        auths = [self.createAuth(user) for i in range(3)]
+
+        # stopping at the limit returns a cursor to continue from
+        cursor = self.model.revokeAuths(user.key, except_key=auths[0].key, limit=2)
+        assert cursor
+
+        cursor = self.model.revokeAuths(user.key, except_key=auths[0].key, cursor=cursor)
+        assert cursor is None
+
+        remaining = self.model.Auth.query(ancestor=user.key).fetch(keys_only=True)
+        assert remaining == [auths[0].key]
+
+        # with no exception everything is revoked
+        self.model.revokeAuths(user.key)
+        assert not self.model.Auth.query(ancestor=user.key).fetch(keys_only=True)
+
+        # and they're all taken out of the stats
+        assert self.model.sumStats()['auths'] == -3
+
     def test_cache(self):
         self.executed = 0
 
@@ -106,3 +260,401 @@ class TestModelFunctions(BaseTestCase):
         result = self.model.cache("test key", testFunction)
         assert result is True
         assert self.executed == 2
+
+    def test_getCache(self):
+        # nothing has been cached yet
+        assert self.model.getCache("test key") is None
+
+        self.model.setCache("test key", "test value" + UCHAR, expires=60)
+        assert self.model.getCache("test key") == "test value" + UCHAR
+
+        # stub the time to be after the value has expired
+        orig_time = self.model.time.time
+        self.model.time.time = lambda: orig_time() + 120
+        try:
+            # the first request to see the expired value gets the lease to refresh it
+            assert self.model.getCache("test key") is None
+
+            # but everyone else is still served the stale value while that happens
+            assert self.model.getCache("test key") == "test value" + UCHAR
+
+            # refreshing the value releases the lease
+            self.model.setCache("test key", "new test value" + UCHAR, expires=60)
+        finally:
+            self.model.time.time = orig_time
+
+        assert self.model.getCache("test key") == "new test value" + UCHAR
+
+    def test_setCache(self):
+        self.model.setCache("test key", "test value" + UCHAR)
+        assert self.model.getCache("test key") == "test value" + UCHAR
+
+        # setting again should overwrite the old value
+        self.model.setCache("test key", "new test value" + UCHAR)
+        assert self.model.getCache("test key") == "new test value" + UCHAR
+
+        # but not right after it has been uncached
+        self.model.uncache("test key")
+        self.model.setCache("test key", "test value" + UCHAR)
+        assert self.model.getCache("test key") is None
+
+        # an expiration of zero never goes stale
+        self.model.setCache("other test key", "test value" + UCHAR, expires=0)
+        orig_time = self.model.time.time
+        self.model.time.time = lambda: orig_time() + 86400 * 365
+        try:
+            result = self.model.getCache("other test key")
+        finally:
+            self.model.time.time = orig_time
+        assert result == "test value" + UCHAR
+
+    def test_getGeneration(self):
+        generation = self.model.getGeneration(self.model.CACHE_PAGES)
+        assert generation
+
+        # the same generation is used until the namespace is invalidated
+        assert self.model.getGeneration(self.model.CACHE_PAGES) == generation
+
+    def test_invalidateCache(self):
+        self.model.setCache("test key", "test value" + UCHAR, namespace=self.model.CACHE_PAGES)
+        self.model.setCache("test key", "other test value" + UCHAR, namespace=self.model.CACHE_USERS)
+
+        generation = self.model.getGeneration(self.model.CACHE_PAGES)
+        new_generation = self.model.invalidateCache(self.model.CACHE_PAGES)
+        assert new_generation > generation
+
+        # only the invalidated namespace should be affected
+        assert self.model.getCache("test key", namespace=self.model.CACHE_PAGES) is None
+        assert self.model.getCache("test key", namespace=self.model.CACHE_USERS) == "other test value" + UCHAR
+
+    def test_cacheKey(self):
+        assert self.model.cacheKey("test key") == "test key"
+
+        generation = self.model.getGeneration(self.model.CACHE_PAGES)
+        result = self.model.cacheKey("test key", self.model.CACHE_PAGES)
+        assert result == self.model.CACHE_PAGES + ":" + str(generation) + ":test key"
+
+
+class TestMissingPaths(BaseTestCase):
+
+    def setUp(self):
+        super(TestMissingPaths, self).setUp()
+        self.orig_rate = self.model.MISSING_SAMPLE_RATE
+        self.model.MISSING_SAMPLE_RATE = 1
+
+    def tearDown(self):
+        self.model.MISSING_SAMPLE_RATE = self.orig_rate
+        super(TestMissingPaths, self).tearDown()
+
+    def test_recordMissingPath(self):
+        assert self.model.recordMissingPath('/missing')
+        assert self.model.recordMissingPath('/missing')
+        assert self.model.recordMissingPath('/other')
+        assert self.model.getMissingPaths() == [('/missing', 2), ('/other', 1)]
+
+        # once it's full the least common path is replaced
+        orig_max = self.model.MISSING_MAX
+        self.model.MISSING_MAX = 2
+        try:
+            self.model.recordMissingPath('/new')
+        finally:
+            self.model.MISSING_MAX = orig_max
+        assert self.model.getMissingPaths() == [('/missing', 2), ('/new', 2)]
+
+    def test_getMissingPaths(self):
+        assert self.model.getMissingPaths() == []
+
+        for i in range(3):
+            self.model.recordMissingPath('/missing' + str(i))
+        assert len(self.model.getMissingPaths(limit=2)) == 2
+
+
+class TestTokens(BaseTestCase):
+
+    def setUp(self):
+        super(TestTokens, self).setUp()
+        # verified tokens are remembered across requests
+        self.model._tokens.clear()
+
+    def test_issueToken(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+        token = self.model.issueToken(auth)
+
+        str_key, secret = token.split(self.model.TOKEN_SEPARATOR)
+        assert str_key == auth.key.urlsafe()
+        # the token itself is never stored
+        assert auth.key.get().token_hash == self.model.hashToken(secret)
+        assert secret not in auth.key.get().token_hash
+
+    def test_tokenKeys(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+        token = self.model.issueToken(auth)
+        assert self.model.tokenKeys(token) == (auth.key.urlsafe(), user.key.urlsafe())
+
+        assert self.model.tokenKeys('invalid.secret') is None
+        # only auths have tokens
+        assert self.model.tokenKeys(user.key.urlsafe() + '.secret') is None
+
+    def test_getByToken(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+        token = self.model.issueToken(auth)
+
+        assert self.model.getByToken(token).key == auth.key
+        assert self.model.getByToken(token + 'x') is None
+        assert self.model.getByToken(auth.key.urlsafe()) is None
+        assert self.model.getByToken('invalid') is None
+
+        # a replaced token stops working once it's no longer remembered
+        new_token = self.model.issueToken(auth)
+        assert self.model.getByToken(new_token).key == auth.key
+        self.model._tokens.clear()
+        assert self.model.getByToken(token) is None
+
+
+class TestStats(BaseTestCase):
+
+    def test_userStats(self):
+        user = self.createUser()
+        day = user.created_date.date().isoformat()
+        assert self.model.userStats(user) == {'users': 1, 'signups:' + day: 1}
+
+        # old signups aren't counted by day
+        user.created_date = datetime(2000, 1, 1)
+        assert self.model.userStats(user, -1) == {'users': -1}
+
+    def test_authStats(self):
+        auth = self.createAuth(self.createUser())
+        stats = self.model.authStats(auth)
+        assert stats['auths'] == 1
+        assert stats['browser:' + auth.browser] == 1
+        assert stats['device:' + auth.device] == 1
+        assert stats['os:' + auth.os] == 1
+
+    def test_updateStats(self):
+        for i in xrange(5):
+            self.model.updateStats({'users': 1, 'auths': 2})
+        self.model.updateStats({'auths': -1, 'unchanged': 0})
+
+        assert self.model.sumStats() == {'users': 5, 'auths': 9}
+        # each update only writes to one shard
+        shards = [shard for shard in self.model.ndb.get_multi(self.model.statsKeys()) if shard]
+        assert 1 <= len(shards) <= 6
+
+    def test_getStats(self):
+        self.model.updateStats({'users': 1})
+        assert self.model.getStats() == {'users': 1}
+
+        # cached for a short while
+        self.model.updateStats({'users': 1})
+        assert self.model.getStats() == {'users': 1}
+
+        self.model.uncache(self.model.STATS_CACHE_KEY, seconds=0)
+        assert self.model.getStats() == {'users': 2}
+
+    def test_countStats(self):
+        user = self.createUser()
+        auths = [self.createAuth(user) for i in range(3)]
+
+        totals = {}
+        cursor = self.model.countStats('User', totals)
+        assert cursor is None
+        assert totals == self.model.userStats(user)
+
+        cursor = self.model.countStats('Auth', totals, limit=2)
+        assert cursor
+        cursor = self.model.countStats('Auth', totals, cursor=cursor, limit=2)
+        assert cursor is None
+        assert totals['auths'] == 3
+        assert totals['browser:' + auths[0].browser] == 3
+
+    def test_reconcileStats(self):
+        for i in xrange(10):
+            self.model.updateStats({'users': 1, 'auths': 1})
+
+        self.model.reconcileStats({'users': 3, 'auths': 0})
+        assert self.model.sumStats() == {'users': 3}
+        assert self.model.getStats() == {'users': 3}
+
+        # everything is compacted into a single shard
+        shards = [shard for shard in self.model.ndb.get_multi(self.model.statsKeys()) if shard and shard.counts]
+        assert len(shards) == 1
+
+    def test_deleteAuth(self):
+        auth = self.createAuth(self.createUser())
+        self.model.deleteAuth(auth.key.urlsafe())
+        assert not auth.key.get()
+        assert self.model.sumStats()['auths'] == -1
+
+        # only auths can be deleted this way
+        user = self.createUser(email='other.test@example.com')
+        self.model.deleteAuth(user.key.urlsafe())
+        assert user.key.get()
+
+
+class TestCacheBatch(BaseTestCase):
+
+    def setUp(self):
+        super(TestCacheBatch, self).setUp()
+        from google.appengine.api import memcache
+        self.memcache = memcache
+        self.batch = self.model.startBatch()
+
+    def tearDown(self):
+        self.model.endBatch()
+        super(TestCacheBatch, self).tearDown()
+
+    def test_get(self):
+        self.memcache.set("test key", "test value" + UCHAR)
+        self.memcache.set("other test key", "other test value" + UCHAR)
+
+        self.batch.prefetch(["test key", "other test key"])
+        assert self.batch.get("test key") == "test value" + UCHAR
+
+        # both keys were fetched together, so changing the second now doesn't affect this request
+        self.memcache.delete("other test key")
+        assert self.batch.get("other test key") == "other test value" + UCHAR
+
+        # misses are remembered too
+        assert self.batch.get("missing test key") is None
+        self.memcache.set("missing test key", "test value" + UCHAR)
+        assert self.batch.get("missing test key") is None
+
+    def test_flush(self):
+        self.model.setCache("test key", "test value" + UCHAR)
+        self.batch.add("other test key", "other test value" + UCHAR)
+
+        # writes are visible within the request but not sent until the batch is flushed
+        assert self.model.getCache("test key") == "test value" + UCHAR
+        assert self.memcache.get("other test key") is None
+
+        self.batch.flush()
+        assert self.memcache.get("other test key") == "other test value" + UCHAR
+
+        # storing a value replaces the one that's already there
+        self.batch.store("other test key", "new test value" + UCHAR)
+        self.batch.flush()
+        assert self.memcache.get("other test key") == "new test value" + UCHAR
+
+    def test_delete(self):
+        self.model.setCache("test key", "test value" + UCHAR)
+
+        # deleting drops any write that was waiting to be flushed
+        self.model.uncache("test key")
+        assert self.model.getCache("test key") is None
+
+        self.batch.flush()
+        assert self.memcache.get("test key") is None
+
+    def test_prefetch(self):
+        user = self.createUser()
+        self.memcache.set(self.model.cacheKey(user.slug, self.model.CACHE_USERS), self.model.encodeEntity(user))
+
+        self.model.prefetch([user.slug], namespace=self.model.CACHE_USERS)
+        assert self.batch.pending
+
+        # the entity comes out of the prefetched value, so the datastore is never asked for it
+        def noGet(key, **kwargs):
+            raise AssertionError("unexpected datastore get")
+
+        orig_get = self.model.ndb.Key.get
+        self.model.ndb.Key.get = noGet
+        try:
+            entity = self.model.getByKey(user.slug)
+        finally:
+            self.model.ndb.Key.get = orig_get
+
+        assert entity.key == user.key
+        assert not self.batch.pending
+
+
+class TestEntityCodec(BaseTestCase):
+
+    def test_encodeEntity(self):
+        user = self.createUser()
+        encoded = self.model.encodeEntity(user)
+        assert encoded.startswith(self.model.CODEC_PLAIN)
+
+        # large values are compressed
+        user.first_name = "a" * self.model.COMPRESS_BYTES
+        encoded = self.model.encodeEntity(user)
+        assert encoded.startswith(self.model.CODEC_COMPRESSED)
+
+    def test_decodeEntity(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+
+        for entity in [user, auth]:
+            decoded = self.model.decodeEntity(self.model.encodeEntity(entity))
+            assert decoded.key == entity.key
+            assert decoded == entity
+
+        assert self.model.decodeEntity(None) is None
+        assert self.model.decodeEntity("unknown format") is None
+
+        # a different version should be ignored
+        encoded = self.model.encodeEntity(user)
+        orig_version = self.model.User.CACHE_VERSION
+        self.model.User.CACHE_VERSION = orig_version + 1
+        self.model._codecs.clear()
+        try:
+            result = self.model.decodeEntity(encoded)
+        finally:
+            self.model.User.CACHE_VERSION = orig_version
+            self.model._codecs.clear()
+
+        assert result is None
+
+
+class TestActivity(BaseTestCase):
+
+    def test_recordActivity(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+        str_key = auth.key.urlsafe()
+
+        assert self.model.recordActivity(str_key, "127.0.0.2")
+
+        # it's only recorded once per window
+        assert not self.model.recordActivity(str_key, "127.0.0.2")
+
+        # and nothing is written to the datastore yet
+        assert auth.key.get().ip == "127.0.0.1"
+
+    def test_flushActivity(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+        self.model.recordActivity(auth.key.urlsafe(), "127.0.0.2")
+
+        # the current window isn't flushed until the one after it is over too
+        assert self.model.flushActivity() == 0
+
+        orig_time = self.model.time.time
+        self.model.time.time = lambda: orig_time() + self.model.ACTIVITY_WINDOW * 2
+        try:
+            assert self.model.flushActivity() == 1
+
+            # a window is only ever flushed once
+            assert self.model.flushActivity() == 0
+        finally:
+            self.model.time.time = orig_time
+
+        auth = auth.key.get()
+        assert auth.ip == "127.0.0.2"
+
+    def test_flushDeletedActivity(self):
+        user = self.createUser()
+        auth = self.createAuth(user)
+        self.model.recordActivity(auth.key.urlsafe(), "127.0.0.2")
+
+        # an auth that's revoked before its activity is flushed stays gone
+        auth.key.delete()
+        orig_time = self.model.time.time
+        self.model.time.time = lambda: orig_time() + self.model.ACTIVITY_WINDOW * 2
+        try:
+            assert self.model.flushActivity() == 0
+        finally:
+            self.model.time.time = orig_time
+        assert auth.key.get() is None
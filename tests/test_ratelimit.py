@@ -0,0 +1,72 @@
+from base import BaseTestCase
+
+
+class TestRateLimit(BaseTestCase):
+
+    def setUp(self):
+        super(TestRateLimit, self).setUp()
+        import ratelimit
+        self.ratelimit = ratelimit
+        self.ratelimit._blocked.clear()
+
+    def tearDown(self):
+        self.ratelimit._blocked.clear()
+        super(TestRateLimit, self).tearDown()
+
+    def test_check(self):
+        limit = self.ratelimit.Limit('ip', 3, 60)
+        values = {'ip': '127.0.0.1'}
+
+        for i in xrange(3):
+            assert self.ratelimit.check('test', [limit], values) == 0
+
+        retry_after = self.ratelimit.check('test', [limit], values)
+        assert 0 < retry_after <= 60
+
+        # other clients and other scopes are counted separately
+        assert self.ratelimit.check('test', [limit], {'ip': '127.0.0.2'}) == 0
+        assert self.ratelimit.check('other', [limit], values) == 0
+
+        # requests without a value aren't limited
+        assert self.ratelimit.check('test', [limit], {'ip': None}) == 0
+
+    def test_seed(self):
+        limit = self.ratelimit.Limit('ip', 3, 60)
+        orig_time = self.ratelimit.time.time
+        self.ratelimit.time.time = lambda: 6000.0
+        try:
+            assert self.ratelimit.check('test', [limit], {'ip': '127.0.0.1'}) == 0
+            assert self.ratelimit.check('test', [limit], {'ip': '127.0.0.1'}) == 0
+        finally:
+            self.ratelimit.time.time = orig_time
+
+        # counters are created with an expiry before they're incremented, and each request is still counted once
+        client = self.ratelimit.clientKey('test', limit, '127.0.0.1')
+        assert self.ratelimit.memcache.get(client + ':100') == 2
+        assert self.ratelimit.memcache.get(client + ':99') == 0
+
+    def test_prefilter(self):
+        limit = self.ratelimit.Limit('email', 1, 60)
+        values = {'email': u'test@example.com'}
+        assert self.ratelimit.check('test', [limit], values) == 0
+        assert self.ratelimit.check('test', [limit], values)
+
+        # a blocked client is turned away on this instance without asking memcache
+        client = self.ratelimit.clientKey('test', limit, values['email'])
+        assert client in self.ratelimit._blocked
+        self.ratelimit.memcache.flush_all()
+        assert self.ratelimit.check('test', [limit], values)
+
+    def test_block(self):
+        orig_max = self.ratelimit.BLOCKED_MAX
+        self.ratelimit.BLOCKED_MAX = 2
+        try:
+            self.ratelimit.block('expired', 0)
+            self.ratelimit.block('first', float('inf'))
+            # expired clients are dropped to make room
+            self.ratelimit.block('second', float('inf'))
+            assert 'expired' not in self.ratelimit._blocked
+            assert 'first' in self.ratelimit._blocked
+            assert 'second' in self.ratelimit._blocked
+        finally:
+            self.ratelimit.BLOCKED_MAX = orig_max
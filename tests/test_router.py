@@ -0,0 +1,60 @@
+import webapp2
+
+from base import BaseTestCase
+
+
+class TestRouter(BaseTestCase):
+
+    def setUp(self):
+        super(TestRouter, self).setUp()
+        import router
+        self.router = router
+
+    def match(self, router, path):
+        try:
+            route, args, kwargs = router.match(webapp2.Request.blank(path))
+        except webapp2.exc.HTTPNotFound:
+            return None, None
+        return route.handler, args
+
+    def test_literalPrefix(self):
+        assert self.router.literalPrefix('/user/login') == ('/user/login', True)
+        assert self.router.literalPrefix(r'/sitemap\.xml') == ('/sitemap.xml', True)
+        assert self.router.literalPrefix(r'/sitemaps/(\d+)\.xml') == ('/sitemaps/', False)
+        assert self.router.literalPrefix('/(.*)') == ('/', False)
+
+        # a quantifier applies to the character before it
+        assert self.router.literalPrefix('/users?') == ('/user', False)
+
+        # an unescaped dot matches anything
+        assert self.router.literalPrefix('/sitemap.xml') == ('/sitemap', False)
+
+        assert self.router.literalPrefix('/a|/b') == ('', False)
+
+    def test_match(self):
+        routes = [
+            ('/', 'index'),
+            ('/user/login', 'login'),
+            (r'/user/(\w+)', 'user'),
+            ('/user/logout', 'logout'),
+            (r'/sitemaps/(\d+)\.xml', 'shard'),
+            ('/(.*)', 'error')
+        ]
+        router = self.router.Router(routes)
+
+        assert self.match(router, '/') == ('index', ())
+        assert self.match(router, '/user/login') == ('login', ())
+        assert self.match(router, '/user/signup') == ('user', ('signup',))
+        assert self.match(router, '/sitemaps/3.xml') == ('shard', ('3',))
+        assert self.match(router, '/sitemaps/x.xml') == ('error', ('sitemaps/x.xml',))
+        assert self.match(router, '/missing') == ('error', ('missing',))
+
+        # routes are still tried in order, so an earlier regex beats a later exact match
+        assert self.match(router, '/user/logout') == ('user', ('logout',))
+
+        # paths are unquoted before matching, the same as webapp2
+        assert self.match(router, '/user/log%69n') == ('login', ())
+
+        # without a catch-all there's nothing to match
+        router = self.router.Router(routes[:-1])
+        assert self.match(router, '/missing') == (None, None)